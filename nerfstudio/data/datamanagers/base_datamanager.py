@@ -76,7 +76,6 @@ from nerfstudio.data.scene_box import OrientedBox
 import numpy as np
 from itertools import compress
 from nerfstudio.data.utils.data_utils import get_image_mask_tensor_from_path
-import matplotlib.pyplot as plt
 import os
 import torch.nn.functional as F
 import time
@@ -745,6 +744,11 @@ class VanillaDataManager(DataManager, Generic[TDataset]):
 
         self.surface_detection_ray_generator = RayGenerator_surface_detection(self.train_dataset.cameras.to(self.device))
 
+        # move the indices and mask to the device once, through pinned memory so the copy does not block
+        if torch.device(self.device).type == "cuda":
+            self.ray_indices = self.ray_indices.pin_memory().to(self.device, non_blocking=True)
+            mask = mask.pin_memory().to(self.device, non_blocking=True)
+
         # create ray bundle from ray indices
         self.ray_bundle_surface_detection = self.surface_detection_ray_generator(self.ray_indices, mask = mask)
 
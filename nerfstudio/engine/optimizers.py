@@ -133,7 +133,8 @@ class Optimizers:
     def zero_grad_all(self) -> None:
         """Zero the gradients for all optimizer parameters."""
         for _, optimizer in self.optimizers.items():
-            optimizer.zero_grad()
+            # free the gradients instead of filling them with zeros, saving a memset per parameter
+            optimizer.zero_grad(set_to_none=True)
 
     def optimizer_scaler_step_all(self, grad_scaler: GradScaler) -> None:
         """Take an optimizer step using a grad scaler.
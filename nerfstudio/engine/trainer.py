@@ -17,21 +17,29 @@ Code to train model.
 """
 from __future__ import annotations
 
+import atexit
 import dataclasses
 import functools
+import io
 import os
 import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from pathlib import Path
-from threading import Lock
-from typing import Dict, List, Literal, Optional, Tuple, Type, cast
+from threading import Event, Lock
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Type
 import wandb
+import numpy as np
 import torch
 from nerfstudio.configs.experiment_config import ExperimentConfig
 from nerfstudio.data.datamanagers.base_datamanager import VanillaDataManager
+from nerfstudio.data.datamanagers.parallel_datamanager import ParallelDataManager
 from nerfstudio.engine.callbacks import TrainingCallback, TrainingCallbackAttributes, TrainingCallbackLocation
 from nerfstudio.engine.optimizers import Optimizers
 from nerfstudio.pipelines.base_pipeline import VanillaPipeline
+from nerfstudio.pipelines.dynamic_batch import DynamicBatchPipeline
 from nerfstudio.utils import profiler, writer
 from nerfstudio.utils.decorators import check_eval_enabled, check_main_thread, check_viewer_enabled
 from nerfstudio.utils.misc import step_check
@@ -43,15 +51,108 @@ from rich import box, style
 from rich.panel import Panel
 from rich.table import Table
 from torch.cuda.amp.grad_scaler import GradScaler
-from sklearn.linear_model import LinearRegression
-import numpy as np
-
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 TRAIN_INTERATION_OUTPUT = Tuple[torch.Tensor, Dict[str, torch.Tensor], Dict[str, torch.Tensor]]
 TORCH_DEVICE = str
+# layout (shape and dtype) of staged checkpoint tensors and their views into flat per dtype host buffers
+CKPT_STAGING = Tuple[List[Tuple[torch.Size, torch.dtype]], List[torch.Tensor]]
+
+
+def _sum_losses(loss_dict: Dict[str, torch.Tensor]) -> torch.Tensor:
+    """Sums the losses of a loss dict, with a single reduction when all of them are scalars.
+
+    Args:
+        loss_dict: losses to sum
+    """
+    losses = tuple(loss_dict.values())
+    if all(loss.dim() == 0 for loss in losses):
+        return torch.stack(losses).sum()
+    # broadcast non-scalar losses like before
+    return functools.reduce(torch.add, losses)
+
+
+def latest_checkpoint_step(load_dir: Path) -> int:
+    """Finds the step of the latest checkpoint in a checkpoint directory.
+
+    Only .ckpt files are considered, so the companion .npz files written with ckpt_tensor_format="npz" are skipped.
+
+    Args:
+        load_dir: directory the checkpoints were saved to
+    """
+    # NOTE: this is specific to the checkpoint name format
+    return max(
+        int(entry.name[entry.name.find("-") + 1 : entry.name.find(".")])
+        for entry in os.scandir(load_dir)
+        if entry.name.endswith(".ckpt")
+    )
+
+
+def load_checkpoint_state(load_path: Path) -> Dict[str, Any]:
+    """Loads a checkpoint onto the cpu, memory-mapping the file where torch supports it.
+
+    Understands all the layouts written by the trainer, including batched snapshots and npz tensor files.
+
+    Args:
+        load_path: path to the checkpoint
+    """
+    # optimizer and scheduler states are not plain weights, so the full unpickler is needed
+    load_kwargs: Dict[str, Any] = {"weights_only": False}
+    if tuple(map(int, torch.__version__.split(".")[:2])) >= (2, 1):
+        # tensor storages are paged in lazily instead of read eagerly into memory
+        load_kwargs["mmap"] = True
+    loaded_state = torch.load(load_path, map_location="cpu", **load_kwargs)
+    # checkpoints written with ckpt_batch_size > 1 hold several snapshots, the file is named after the latest one
+    if "snapshots" in loaded_state:
+        return loaded_state["snapshots"][-1]
+    # checkpoints written with ckpt_tensor_format="npz" keep the pipeline tensors in a companion file
+    tensor_file = loaded_state.pop("pipeline_tensor_file", None)
+    if tensor_file is not None:
+        with np.load(Path(load_path).with_name(tensor_file)) as arrays:
+            loaded_state["pipeline"].update({name: torch.from_numpy(arrays[name]) for name in arrays.files})
+    return loaded_state
+
+
+def _map_tensors(state: Any, fn: Callable[[torch.Tensor], Any]) -> Any:
+    """Recursively applies fn to the tensors of a (nested) state dict.
+
+    Args:
+        state: state dict, or any value nested inside one
+        fn: function to apply to every tensor
+
+    Returns:
+        A copy of the containers of the state, with every tensor replaced by its fn result.
+    """
+    if isinstance(state, torch.Tensor):
+        return fn(state)
+    if isinstance(state, dict):
+        return {key: _map_tensors(value, fn) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_map_tensors(value, fn) for value in state)
+    return state
+
+
+def _state_to_cpu(state: Any) -> Any:
+    """Recursively copies the tensors of a (nested) state dict to the CPU.
+
+    Args:
+        state: state dict, or any value nested inside one
+
+    Returns:
+        A copy of the state that shares no tensors or containers with the input.
+    """
+    return _map_tensors(state, lambda tensor: tensor.detach().to("cpu", copy=True))
+
+
+def _wait_for_checkpoints_at_exit(trainer_ref: weakref.ReferenceType) -> None:
+    """Finishes the checkpoint writes of a trainer at interpreter exit, if the trainer is still alive.
+
+    Args:
+        trainer_ref: weak reference to the trainer
+    """
+    trainer = trainer_ref()
+    if trainer is not None:
+        trainer._wait_for_checkpoints(synchronous=True)
 
 
 @dataclass
@@ -72,10 +173,21 @@ class TrainerConfig(ExperimentConfig):
     """Maximum number of iterations to run."""
     mixed_precision: bool = False
     """Whether or not to use mixed precision for training."""
+    force_amp_any_device: bool = False
+    """Keep mixed precision enabled on non-CUDA devices, where autocast is usually slower than full precision."""
     use_grad_scaler: bool = False
     """Use gradient scaler even if the automatic mixed precision is disabled."""
     save_only_latest_checkpoint: bool = True
     """Whether to only save the latest checkpoint or all checkpoints."""
+    ckpt_tensor_format: Literal["torch", "npz"] = "torch"
+    """Format of the pipeline tensors in checkpoints. "npz" writes them with numpy to a companion .npz file, which is
+    faster for large models, and keeps the rest of the state in the .ckpt file."""
+    ckpt_max_pinned_mb: int = 4096
+    """Maximum size of the reused host buffer that checkpoints are staged in. Larger states are copied to freshly
+    allocated host memory on every save."""
+    ckpt_batch_size: int = 1
+    """Number of checkpoint snapshots kept in host memory and written together as one file. The file is named after
+    the latest snapshot, which is the one that gets loaded."""
     # optional parameters if we want to resume training
     load_dir: Optional[Path] = None
     """Optionally specify a pre-trained model directory to load from."""
@@ -86,9 +198,20 @@ class TrainerConfig(ExperimentConfig):
     load_checkpoint: Optional[Path] = None
     """Path to checkpoint file."""
     log_gradients: bool = False
-    """Optionally log gradients during training"""
+    """Optionally log gradients during training, on every logging step"""
     gradient_accumulation_steps: int = 1
     """Number of steps to accumulate gradients over."""
+    fuse_accumulation: bool = False
+    """Replace the gradient accumulation micro-steps by a single step on a gradient_accumulation_steps times larger
+    ray batch, trading peak memory for fewer forward and backward passes."""
+    steps_per_empty_cache: int = 0
+    """Number of steps between releasing unused cached CUDA memory, to reduce fragmentation. 0 disables it."""
+    enable_surface_plot: bool = False
+    """Whether to save a 3D plot of the fitted plane and the object bbox during plane estimation."""
+    compile_mode: Optional[Literal["default", "reduce-overhead", "max-autotune"]] = None
+    """Optionally compile the model with torch.compile using this mode, CUDA only."""
+    compile_target: Literal["field", "model"] = "field"
+    """Compile only the field of the model, or the forward of the whole model including ray sampling."""
 
 
 class Trainer:
@@ -117,19 +240,27 @@ class Trainer:
     def __init__(self, config: TrainerConfig, local_rank: int = 0, world_size: int = 1) -> None:
         self.train_lock = Lock()
         self.config = config
+        # asdict deep-copies the whole nested config tree, so it is serialized only once
+        self._config_dict: Dict[str, Any] = dataclasses.asdict(config)
         self.local_rank = local_rank
         self.world_size = world_size
         self.device: TORCH_DEVICE = config.machine.device_type
         if self.device == "cuda":
             self.device += f":{local_rank}"
+        self._device_type: str = self.device.split(":")[0]
         self.mixed_precision: bool = self.config.mixed_precision
         self.use_grad_scaler: bool = self.mixed_precision or self.config.use_grad_scaler
+        # set while training may run, cleared while paused so the train loop can block on it
+        self._resume_event = Event()
         self.training_state: Literal["training", "paused", "completed"] = "training"
         self.gradient_accumulation_steps: int = self.config.gradient_accumulation_steps
 
-        if self.device == "cpu":
+        if self.mixed_precision and self._device_type != "cuda" and not self.config.force_amp_any_device:
             self.mixed_precision = False
-            CONSOLE.print("Mixed precision is disabled for CPU training.")
+            CONSOLE.print(
+                f"Mixed precision is disabled for {self._device_type.upper()} training, "
+                "set force_amp_any_device to keep it enabled."
+            )
         self._start_step: int = 0
         # optimizers
         self.grad_scaler = GradScaler(enabled=self.use_grad_scaler)
@@ -141,6 +272,45 @@ class Trainer:
 
         self.viewer_state = None
 
+        # checkpoints are staged into one of two pinned host buffers and written by a background thread
+        self._ckpt_executor = ThreadPoolExecutor(max_workers=1)
+        self._ckpt_lock = Lock()
+        # per buffer, the (shape, dtype) layout of the staged tensors and their views into flat per dtype buffers
+        self._ckpt_buffers: List[Optional[CKPT_STAGING]] = [None, None]
+        self._ckpt_futures: List[Optional[Future]] = [None, None]
+        self._ckpt_buffer_idx: int = 0
+        # last checkpoint written by the checkpoint thread, the only file left to delete on the next write
+        self._prev_ckpt_path: Optional[Path] = None
+        # optimizer steps taken so far and at the last save, checkpoints without a new step in between are skipped
+        self._opt_steps: int = 0
+        self._last_saved_opt_steps: Optional[int] = None
+        # host snapshots waiting to be written as one file when ckpt_batch_size > 1
+        self._ckpt_pending: List[Dict[str, Any]] = []
+        self._ckpt_stream = torch.cuda.Stream(device=self.device) if self.device.startswith("cuda") else None
+        # finish (and surface errors of) any write still in flight when the interpreter exits, the partial batch is
+        # written inline since concurrent.futures refuses new work by the time atexit handlers run. Only a weak
+        # reference is registered so that the handler does not keep the trainer alive.
+        atexit.register(_wait_for_checkpoints_at_exit, weakref.ref(self))
+
+    def __del__(self) -> None:
+        ckpt_executor = getattr(self, "_ckpt_executor", None)
+        if ckpt_executor is not None:
+            ckpt_executor.shutdown(wait=True)
+
+    @property
+    def training_state(self) -> Literal["training", "paused", "completed"]:
+        """Get training state flag."""
+        return self._training_state
+
+    @training_state.setter
+    def training_state(self, training_state: Literal["training", "paused", "completed"]) -> None:
+        """Set training state flag and wake up a paused train loop."""
+        self._training_state = training_state
+        if training_state == "paused":
+            self._resume_event.clear()
+        else:
+            self._resume_event.set()
+
     def setup(self, test_mode: Literal["test", "val", "inference"] = "val") -> None:
         """Setup the Trainer by calling other setup functions.
 
@@ -160,6 +330,15 @@ class Trainer:
             # load_dir=Path('outputs/polycam_mate_floor/depth-nerfacto/2023-12-09_000432/nerfstudio_models'), # extremely HARDCODED!!!
             base_dir=self.base_dir, # added
         )
+        if self.config.fuse_accumulation and self.gradient_accumulation_steps > 1:
+            self._fuse_accumulation()
+        if self.config.log_gradients:
+            # the parameters are fixed once the model is built, so the module tree is only walked here
+            self._named_params = list(self.pipeline.model.named_parameters())
+            # the total gradient norm is logged under this tag, checked once instead of on every logging step
+            assert all(tag != "Total" for tag, _ in self._named_params)
+        if self.config.compile_mode is not None:
+            self._compile_model()
         self.optimizers = self.setup_optimizers()
 
         # set up viewer if enabled
@@ -217,9 +396,60 @@ class Trainer:
         writer.setup_local_writer(
             self.config.logging, max_iter=self.config.max_num_iterations, banner_messages=banner_messages
         )
-        writer.put_config(name="config", config_dict=dataclasses.asdict(self.config), step=0)
+        writer.put_config(name="config", config_dict=self._config_dict, step=0)
         profiler.setup_profiler(self.config.logging, writer_log_path)
 
+    def _fuse_accumulation(self) -> None:
+        """Samples all accumulation micro-batches as one ray batch so that a single backward pass is needed.
+
+        The losses are means over the rays of a batch, so one larger batch matches averaging the micro-batches.
+        """
+        datamanager = self.pipeline.datamanager
+        train_pixel_sampler = getattr(datamanager, "train_pixel_sampler", None)
+        # the dynamic batch pipeline resizes the batch after every step, and the parallel datamanager's workers
+        # already hold their own copy of the pixel sampler which a resize in this process does not reach
+        if (
+            train_pixel_sampler is None
+            or isinstance(self.pipeline, DynamicBatchPipeline)
+            or isinstance(datamanager, ParallelDataManager)
+        ):
+            CONSOLE.print("[bold yellow]Warning: this pipeline cannot fuse gradient accumulation, not fusing.")
+            return
+        num_rays_per_batch = datamanager.get_train_rays_per_batch() * self.gradient_accumulation_steps
+        train_pixel_sampler.set_num_rays_per_batch(num_rays_per_batch)
+        CONSOLE.print(
+            f"Fused {self.gradient_accumulation_steps} gradient accumulation steps into batches of "
+            f"{train_pixel_sampler.num_rays_per_batch} rays."
+        )
+        self.gradient_accumulation_steps = 1
+
+    def _compile_model(self) -> None:
+        """Compiles the field or the whole pipeline model with torch.compile.
+
+        Compiling only the field is the default since ray generation and sampling around it produce data dependent
+        shapes that can keep triggering recompilation. The whole model is compiled with dynamic shapes instead.
+        """
+        if self._device_type != "cuda":
+            CONSOLE.print("[bold yellow]Warning: torch.compile is only used for CUDA training, not compiling.")
+            return
+        if self.config.compile_target == "model":
+            module = self.pipeline.model
+        else:
+            module = getattr(self.pipeline.model, "field", None)
+        if not hasattr(torch, "compile") or not isinstance(module, torch.nn.Module):
+            CONSOLE.print(
+                "[bold yellow]Warning: torch.compile is unavailable or the model has no field, not compiling."
+            )
+            return
+        # compile the forward in place so that the state dict keys stay unchanged,
+        # not in fullgraph mode since the custom CUDA extensions used by fields cause graph breaks
+        module.forward = torch.compile(
+            module.forward, mode=self.config.compile_mode, dynamic=self.config.compile_target == "model"
+        )
+        CONSOLE.print(
+            f"Compiled the {self.config.compile_target} with torch.compile (mode={self.config.compile_mode})."
+        )
+
     def setup_optimizers(self) -> Optimizers:
         """Helper to set up the optimizers
 
@@ -244,9 +474,11 @@ class Trainer:
         with TimeWriter(writer, EventName.TOTAL_TRAIN_TIME):
             num_iterations = self.config.max_num_iterations
             step = 0
+            # the batch size is fixed unless the pipeline resizes it after every iteration
+            train_rays_per_batch = self.pipeline.datamanager.get_train_rays_per_batch()
+            dynamic_rays_per_batch = isinstance(self.pipeline, DynamicBatchPipeline)
             for step in range(self._start_step, self._start_step + num_iterations):
-                while self.training_state == "paused":
-                    time.sleep(0.01)
+                self._resume_event.wait()
                 with self.train_lock:
                     with TimeWriter(writer, EventName.ITER_TRAIN_TIME, step=step) as train_t:
                         self.pipeline.train()
@@ -266,21 +498,19 @@ class Trainer:
                                 step, location=TrainingCallbackLocation.AFTER_TRAIN_ITERATION
                             )
 
-                # Skip the first two steps to avoid skewed timings that break the viewer rendering speed estimate.
-                if step > 1:
-                    writer.put_time(
-                        name=EventName.TRAIN_RAYS_PER_SEC,
-                        duration=self.world_size
-                        * self.pipeline.datamanager.get_train_rays_per_batch()
-                        / max(0.001, train_t.duration),
-                        step=step,
-                        avg_over_steps=True,
-                    )
-
-                self._update_viewer_state(step)
+                if dynamic_rays_per_batch:
+                    train_rays_per_batch = self.pipeline.datamanager.get_train_rays_per_batch()
 
                 # a batch of train rays
                 if step_check(step, self.config.logging.steps_per_log, run_at_zero=True):
+                    # Skip the first two steps to avoid skewed timings that break the viewer rendering speed estimate.
+                    if step > 1:
+                        writer.put_time(
+                            name=EventName.TRAIN_RAYS_PER_SEC,
+                            duration=self.world_size * train_rays_per_batch / max(0.001, train_t.duration),
+                            step=step,
+                            avg_over_steps=True,
+                        )
                     writer.put_scalar(name="Train Loss", scalar=loss, step=step)
                     writer.put_dict(name="Train Loss Dict", scalar_dict=loss_dict, step=step)
                     writer.put_dict(name="Train Metrics Dict", scalar_dict=metrics_dict, step=step)
@@ -289,10 +519,15 @@ class Trainer:
                     # allocator and some context needs to be created on GPU. See Memory management
                     # (https://pytorch.org/docs/stable/notes/cuda.html#cuda-memory-management)
                     # for more details about GPU memory management.
-                    writer.put_scalar(
-                        name="GPU Memory (MB)", scalar=torch.cuda.max_memory_allocated() / (1024**2), step=step
-                    )
-                
+                    # The peak is reset after each log, so this is the peak since the previous log.
+                    if self.device.startswith("cuda"):
+                        writer.put_scalar(
+                            name="GPU Memory (MB)", scalar=torch.cuda.max_memory_allocated() / (1024**2), step=step
+                        )
+                        torch.cuda.reset_peak_memory_stats()
+
+                self._update_viewer_state(step, train_rays_per_batch)
+
                 if self.pipeline.datamanager.eval_dataset:
                     self.eval_iteration(step)
 
@@ -303,6 +538,7 @@ class Trainer:
 
         # save checkpoint at the end of training
         self.save_checkpoint(step)
+        self._wait_for_checkpoints()
 
         # write out any remaining events (e.g., total train time)
         writer.write_out_storage()
@@ -350,15 +586,15 @@ class Trainer:
         )
 
     @check_viewer_enabled
-    def _update_viewer_state(self, step: int) -> None:
+    def _update_viewer_state(self, step: int, num_rays_per_batch: int) -> None:
         """Updates the viewer state by rendering out scene with current pipeline
         Returns the time taken to render scene.
 
         Args:
             step: current train step
+            num_rays_per_batch: number of train rays per batch
         """
         assert self.viewer_state is not None
-        num_rays_per_batch: int = self.pipeline.datamanager.get_train_rays_per_batch()
         try:
             self.viewer_state.update_scene(step, num_rays_per_batch)
         except RuntimeError:
@@ -376,8 +612,9 @@ class Trainer:
             time.sleep(0.03)  # sleep to allow buffer to reset
             CONSOLE.log("Viewer failed. Continuing training.")
         CONSOLE.print("Use ctrl+c to quit", justify="center")
+        # wake up rarely while idling, ctrl+c still interrupts the sleep right away
         while True:
-            time.sleep(0.01)
+            time.sleep(1.0)
 
     @check_viewer_enabled
     def _update_viewer_rays_per_sec(self, train_t: TimeWriter, vis_t: TimeWriter, step: int) -> None:
@@ -404,11 +641,10 @@ class Trainer:
             load_step = self.config.load_step
             if load_step is None:
                 print("Loading latest Nerfstudio checkpoint from load_dir...")
-                # NOTE: this is specific to the checkpoint name format
-                load_step = sorted(int(x[x.find("-") + 1 : x.find(".")]) for x in os.listdir(load_dir))[-1]
+                load_step = latest_checkpoint_step(load_dir)
             load_path: Path = load_dir / f"step-{load_step:09d}.ckpt"
             assert load_path.exists(), f"Checkpoint {load_path} does not exist"
-            loaded_state = torch.load(load_path, map_location="cpu")
+            loaded_state = load_checkpoint_state(load_path)
             self._start_step = loaded_state["step"] + 1
             # load the checkpoints for pipeline, optimizers, and gradient scalar
             self.pipeline.load_pipeline(loaded_state["pipeline"], loaded_state["step"])
@@ -419,7 +655,7 @@ class Trainer:
             CONSOLE.print(f"Done loading Nerfstudio checkpoint from {load_path}")
         elif load_checkpoint is not None:
             assert load_checkpoint.exists(), f"Checkpoint {load_checkpoint} does not exist"
-            loaded_state = torch.load(load_checkpoint, map_location="cpu")
+            loaded_state = load_checkpoint_state(load_checkpoint)
             self._start_step = loaded_state["step"] + 1
             # load the checkpoints for pipeline, optimizers, and gradient scalar
             self.pipeline.load_pipeline(loaded_state["pipeline"], loaded_state["step"])
@@ -435,32 +671,233 @@ class Trainer:
     def save_checkpoint(self, step: int) -> None:
         """Save the model and optimizers
 
+        The state is copied to host memory before returning, while serializing and writing it to disk
+        happens on a background thread.
+
         Args:
             step: number of steps in training for given checkpoint
         """
+        if self._opt_steps == self._last_saved_opt_steps:
+            # the model and optimizer state are unchanged since the last checkpoint
+            return
+        self._last_saved_opt_steps = self._opt_steps
         # possibly make the checkpoint directory
         if not self.checkpoint_dir.exists():
             self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
         # save the checkpoint
         ckpt_path: Path = self.checkpoint_dir / f"step-{step:09d}.ckpt"
-        torch.save(
-            {
-                "step": step,
-                "pipeline": self.pipeline.module.state_dict()  # type: ignore
-                if hasattr(self.pipeline, "module")
-                else self.pipeline.state_dict(),
-                "optimizers": {k: v.state_dict() for (k, v) in self.optimizers.optimizers.items()},
-                "schedulers": {k: v.state_dict() for (k, v) in self.optimizers.schedulers.items()},
-                "scalers": self.grad_scaler.state_dict(),
-            },
-            ckpt_path,
+        pipeline_state = (
+            self.pipeline.module.state_dict()  # type: ignore
+            if hasattr(self.pipeline, "module")
+            else self.pipeline.state_dict()
         )
+        with self._ckpt_lock:
+            if self.config.ckpt_batch_size > 1:
+                self._queue_batched_checkpoint(step, pipeline_state)
+                return
+            buffer_idx = self._ckpt_buffer_idx
+            self._ckpt_buffer_idx = 1 - buffer_idx
+            # a staging buffer can only be refilled once the write that reads from it has finished
+            pending = self._ckpt_futures[buffer_idx]
+            if pending is not None:
+                pending.result()
+            state = self._stage_state(
+                {
+                    "step": step,
+                    "pipeline": pipeline_state,
+                    "optimizers": {k: v.state_dict() for (k, v) in self.optimizers.optimizers.items()},
+                    "schedulers": {k: v.state_dict() for (k, v) in self.optimizers.schedulers.items()},
+                    "scalers": self.grad_scaler.state_dict(),
+                },
+                buffer_idx,
+            )
+            self._ckpt_futures[buffer_idx] = self._ckpt_executor.submit(self._write_checkpoint, state, ckpt_path)
+
+    def _queue_batched_checkpoint(self, step: int, pipeline_state: Dict[str, Any]) -> None:
+        """Keeps a host snapshot of the state and writes the queued snapshots every ckpt_batch_size saves.
+
+        The snapshots outlive the next save, so they are copied into fresh host memory instead of the staging buffers.
+
+        Args:
+            step: number of steps in training for given checkpoint
+            pipeline_state: state dict of the pipeline
+        """
+        state = {
+            "step": step,
+            "pipeline": _state_to_cpu(pipeline_state),
+            "optimizers": _state_to_cpu({k: v.state_dict() for (k, v) in self.optimizers.optimizers.items()}),
+            "schedulers": _state_to_cpu({k: v.state_dict() for (k, v) in self.optimizers.schedulers.items()}),
+            "scalers": _state_to_cpu(self.grad_scaler.state_dict()),
+        }
+        # the final save of a run can repeat the step of the last periodic one
+        if self._ckpt_pending and self._ckpt_pending[-1]["step"] == step:
+            self._ckpt_pending.pop()
+        self._ckpt_pending.append(state)
+        if len(self._ckpt_pending) >= self.config.ckpt_batch_size:
+            self._flush_checkpoints()
+
+    def _take_pending_checkpoints(self) -> Optional[Tuple[Dict[str, Any], Path]]:
+        """Removes the queued snapshots and returns them as one checkpoint state with its path, or None if there are
+        none. Expects _ckpt_lock to be held."""
+        if not self._ckpt_pending:
+            return None
+        snapshots, self._ckpt_pending = self._ckpt_pending, []
+        step = snapshots[-1]["step"]
+        return {"step": step, "snapshots": snapshots}, self.checkpoint_dir / f"step-{step:09d}.ckpt"
+
+    def _flush_checkpoints(self) -> None:
+        """Hands the queued snapshots to the checkpoint thread as a single file. Expects _ckpt_lock to be held."""
+        pending_checkpoints = self._take_pending_checkpoints()
+        if pending_checkpoints is None:
+            return
+        state, ckpt_path = pending_checkpoints
+        buffer_idx = self._ckpt_buffer_idx
+        self._ckpt_buffer_idx = 1 - buffer_idx
+        # bound the number of batches held in memory to the two in flight
+        pending = self._ckpt_futures[buffer_idx]
+        if pending is not None:
+            pending.result()
+        self._ckpt_futures[buffer_idx] = self._ckpt_executor.submit(self._write_checkpoint, state, ckpt_path)
+
+    def _stage_state(self, state: Dict[str, Any], buffer_idx: int) -> Dict[str, Any]:
+        """Copies the tensors of a nested state into views of flat host buffers that are reused across checkpoints.
+
+        On CUDA the buffer is pinned and the copies run without blocking on the checkpoint stream, with a single
+        synchronization at the end. States larger than ckpt_max_pinned_mb are copied to regular host memory instead.
+
+        Args:
+            state: checkpoint state to copy
+            buffer_idx: staging buffer to copy into
+
+        Returns:
+            The state with its tensors replaced by host copies.
+        """
+        tensors: List[torch.Tensor] = []
+        _map_tensors(state, tensors.append)
+        layout = [(tensor.shape, tensor.dtype) for tensor in tensors]
+        staging = self._ckpt_buffers[buffer_idx]
+        if staging is None or staging[0] != layout:
+            staging = self._allocate_staging(layout)
+            if staging is None:
+                return _state_to_cpu(state)
+            self._ckpt_buffers[buffer_idx] = staging
+        views = staging[1]
+
+        pin_memory = self._ckpt_stream is not None
+        if self._ckpt_stream is not None:
+            # copy on a side stream, after all the work that produced the tensors is done
+            self._ckpt_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self._ckpt_stream) if self._ckpt_stream is not None else nullcontext():
+            for view, tensor in zip(views, tensors):
+                view.copy_(tensor.detach(), non_blocking=pin_memory)
+        if self._ckpt_stream is not None:
+            self._ckpt_stream.synchronize()
+        hosts = iter(views)
+        return _map_tensors(state, lambda _: next(hosts))
+
+    def _allocate_staging(self, layout: List[Tuple[torch.Size, torch.dtype]]) -> Optional[CKPT_STAGING]:
+        """Allocates the staging buffers for a tensor layout.
+
+        Each dtype gets one flat host buffer, pinned if on CUDA, that is carved into views of the tensors. torch.save
+        refuses tensors that view the same storage as different dtypes, so the dtypes cannot share a buffer.
+
+        Args:
+            layout: shape and dtype of every tensor to stage
+
+        Returns:
+            The layout and the views, or None if the buffers would exceed ckpt_max_pinned_mb.
+        """
+        numels: Dict[torch.dtype, int] = {}
+        offsets = []
+        for shape, dtype in layout:
+            offsets.append(numels.get(dtype, 0))
+            numels[dtype] = offsets[-1] + shape.numel()
+        total = sum(numel * torch.empty((), dtype=dtype).element_size() for dtype, numel in numels.items())
+        if total > self.config.ckpt_max_pinned_mb * 1024**2:
+            return None
+        flats = {
+            dtype: torch.empty(numel, dtype=dtype, pin_memory=self._ckpt_stream is not None)
+            for dtype, numel in numels.items()
+        }
+        views = [
+            flats[dtype][offset : offset + shape.numel()].view(shape)
+            for offset, (shape, dtype) in zip(offsets, layout)
+        ]
+        return layout, views
+
+    def _write_checkpoint(self, state: Dict[str, Any], ckpt_path: Path) -> None:
+        """Serializes a staged checkpoint to disk. Runs on the checkpoint thread.
+
+        Args:
+            state: checkpoint state with all tensors on the host
+            ckpt_path: path to write the checkpoint to
+        """
+        if self.config.ckpt_tensor_format == "npz" and "snapshots" not in state:
+            state = self._write_tensor_file(state, ckpt_path)
+        # serialize in memory so the file is written with a single large write
+        buffer = io.BytesIO()
+        # protocol 5 (PEP 574) pickles the non-tensor metadata without extra buffer copies
+        torch.save(state, buffer, _use_new_zipfile_serialization=True, pickle_protocol=5)
+        # write next to the final path and rename, so a crash never leaves a truncated checkpoint behind
+        tmp_path = ckpt_path.with_suffix(".tmp")
+        tmp_path.write_bytes(buffer.getbuffer())
+        os.replace(tmp_path, ckpt_path)
         # possibly delete old checkpoints
         if self.config.save_only_latest_checkpoint:
-            # delete everything else in the checkpoint folder
-            for f in self.checkpoint_dir.glob("*"):
-                if f != ckpt_path:
-                    f.unlink()
+            if self._prev_ckpt_path is None:
+                # delete everything else in the checkpoint folder
+                for f in self.checkpoint_dir.glob("*"):
+                    if f not in (ckpt_path, ckpt_path.with_suffix(".npz")):
+                        f.unlink()
+            elif self._prev_ckpt_path != ckpt_path:
+                # afterwards the folder only holds the checkpoint written before this one
+                for f in (self._prev_ckpt_path, self._prev_ckpt_path.with_suffix(".npz")):
+                    if f.exists():
+                        f.unlink()
+        self._prev_ckpt_path = ckpt_path
+
+    def _write_tensor_file(self, state: Dict[str, Any], ckpt_path: Path) -> Dict[str, Any]:
+        """Writes the pipeline tensors of a checkpoint to a companion .npz file. Runs on the checkpoint thread.
+
+        Args:
+            state: checkpoint state with all tensors on the host
+            ckpt_path: path the rest of the checkpoint is written to
+
+        Returns:
+            The state without the tensors written to the .npz file, and with a reference to it.
+        """
+        pipeline_state = dict(state["pipeline"])
+        arrays = {}
+        for name, tensor in state["pipeline"].items():
+            # numpy has no bfloat16, such tensors stay in the torch file
+            if isinstance(tensor, torch.Tensor) and tensor.dtype != torch.bfloat16:
+                arrays[name] = tensor.numpy()
+                del pipeline_state[name]
+        tensor_path = ckpt_path.with_suffix(".npz")
+        tmp_path = tensor_path.with_suffix(".npz.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, tensor_path)
+        return {**state, "pipeline": pipeline_state, "pipeline_tensor_file": tensor_path.name}
+
+    def _wait_for_checkpoints(self, synchronous: bool = False) -> None:
+        """Blocks until all checkpoints, including partially filled batches, are on disk.
+
+        Args:
+            synchronous: write the partially filled batch on the calling thread instead of the checkpoint thread.
+                Needed at interpreter exit, where the executor is shut down before atexit handlers run.
+        """
+        if not synchronous:
+            with self._ckpt_lock:
+                self._flush_checkpoints()
+        for future in self._ckpt_futures:
+            if future is not None:
+                future.result()
+        if synchronous:
+            with self._ckpt_lock:
+                pending_checkpoints = self._take_pending_checkpoints()
+                if pending_checkpoints is not None:
+                    self._write_checkpoint(*pending_checkpoints)
 
     @profiler.time_function
     def train_iteration(self, step: int) -> TRAIN_INTERATION_OUTPUT:
@@ -471,56 +908,118 @@ class Trainer:
         """
 
         self.optimizers.zero_grad_all()
-        cpu_or_cuda_str: str = self.device.split(":")[0]
         assert (
             self.gradient_accumulation_steps > 0
         ), f"gradient_accumulation_steps must be > 0, not {self.gradient_accumulation_steps}"
-        for _ in range(self.gradient_accumulation_steps):
-            with torch.autocast(device_type=cpu_or_cuda_str, enabled=self.mixed_precision):
-                _, loss_dict, metrics_dict = self.pipeline.get_train_loss_dict(step=step)
-                loss = functools.reduce(torch.add, loss_dict.values())
-                loss /= self.gradient_accumulation_steps
-            self.grad_scaler.scale(loss).backward()  # type: ignore
+        # built once and entered per micro-step, the backward pass stays outside of autocast
+        autocast = torch.autocast(device_type=self._device_type, enabled=self.mixed_precision)
+        ddp_model = self.pipeline._model
+        for accumulation_step in range(self.gradient_accumulation_steps):
+            # only all-reduce the gradients of the last micro-step, no_sync has to enclose the forward pass too
+            is_last_accumulation_step = accumulation_step == self.gradient_accumulation_steps - 1
+            with ddp_model.no_sync() if isinstance(ddp_model, DDP) and not is_last_accumulation_step else nullcontext():
+                with autocast:
+                    _, loss_dict, metrics_dict = self.pipeline.get_train_loss_dict(step=step)
+                    loss = _sum_losses(loss_dict)
+                scaled_loss = self.grad_scaler.scale(loss)
+                if self.gradient_accumulation_steps > 1:
+                    # average the micro-steps on the already scaled loss, no extra op without accumulation
+                    scaled_loss = scaled_loss * (1.0 / self.gradient_accumulation_steps)
+                scaled_loss.backward()  # type: ignore
+        if self.gradient_accumulation_steps > 1:
+            # report the last micro-step's share of the averaged loss, as before the average moved into backward
+            loss = loss.detach() / self.gradient_accumulation_steps
         self.optimizers.optimizer_scaler_step_all(self.grad_scaler)
 
-        if self.config.log_gradients:
-            total_grad = 0
-            for tag, value in self.pipeline.model.named_parameters():
-                assert tag != "Total"
+        # the gradient norms are only written out on logging steps
+        if self.config.log_gradients and step_check(step, self.config.logging.steps_per_log, run_at_zero=True):
+            tags, grads = [], []
+            for tag, value in self._named_params:
                 if value.grad is not None:
-                    grad = value.grad.norm()
-                    metrics_dict[f"Gradients/{tag}"] = grad  # type: ignore
-                    total_grad += grad
+                    tags.append(tag)
+                    grads.append(value.grad)
+            # one multi-tensor kernel for all the norms instead of one launch per parameter
+            norms = torch._foreach_norm(grads) if grads else []
+            for tag, grad in zip(tags, norms):
+                metrics_dict[f"Gradients/{tag}"] = grad  # type: ignore
+            total_grad = torch.stack(norms).sum() if norms else torch.zeros((), device=self.device)
 
-            metrics_dict["Gradients/Total"] = cast(torch.Tensor, total_grad)  # type: ignore
+            metrics_dict["Gradients/Total"] = total_grad  # type: ignore
 
-        scale = self.grad_scaler.get_scale()
+        optimizer_step_skipped = self._optimizer_step_skipped()
         self.grad_scaler.update()
         # If the gradient scaler is decreased, no optimization step is performed so we should not step the scheduler.
-        if scale <= self.grad_scaler.get_scale():
+        if not optimizer_step_skipped:
             self.optimizers.scheduler_step_all(step)
+            self._opt_steps += 1
+
+        self._maybe_empty_cache(step)
 
         # Merging loss and metrics dict into a single output.
         return loss, loss_dict, metrics_dict  # type: ignore
 
+    def _optimizer_step_skipped(self) -> bool:
+        """Returns whether the grad scaler skipped an optimizer step because of inf/NaN gradients.
+
+        Reads the inf checks of every optimizer and device with a single host read, instead of comparing the scale
+        before and after update(), which costs a blocking read of the scale tensor each. Has to be called before
+        update().
+        """
+        if not self.grad_scaler.is_enabled():
+            return False
+        found_infs = [
+            found_inf
+            for state in self.grad_scaler._per_optimizer_states.values()
+            for found_inf in state.get("found_inf_per_device", {}).values()
+        ]
+        if not found_infs:
+            return False
+        device = found_infs[0].device
+        return torch.stack([found_inf.to(device) for found_inf in found_infs]).sum().item() > 0
+
+    def _maybe_empty_cache(self, step: int) -> None:
+        """Returns the cached but unused blocks of the CUDA allocator every steps_per_empty_cache steps.
+
+        Args:
+            step: Current training step.
+        """
+        if self._device_type == "cuda" and step_check(step, self.config.steps_per_empty_cache):
+            torch.cuda.empty_cache()
+
     @check_eval_enabled
-    @profiler.time_function
     def eval_iteration(self, step: int) -> None:
         """Run one iteration with different batch/image/all image evaluations depending on step size.
 
         Args:
             step: Current training step.
         """
+        eval_batch = step_check(step, self.config.steps_per_eval_batch)
+        eval_image = step_check(step, self.config.steps_per_eval_image)
+        eval_all_images = step_check(step, self.config.steps_per_eval_all_images)
+        # most steps evaluate nothing, return before entering the profiler
+        if eval_batch or eval_image or eval_all_images:
+            self._eval_iteration(step, eval_batch, eval_image, eval_all_images)
+
+    @profiler.time_function
+    def _eval_iteration(self, step: int, eval_batch: bool, eval_image: bool, eval_all_images: bool) -> None:
+        """Runs the evaluations that are due at this step.
+
+        Args:
+            step: Current training step.
+            eval_batch: whether to evaluate a batch of eval rays
+            eval_image: whether to evaluate one eval image
+            eval_all_images: whether to evaluate all eval images
+        """
         # a batch of eval rays
-        if step_check(step, self.config.steps_per_eval_batch):
+        if eval_batch:
             _, eval_loss_dict, eval_metrics_dict = self.pipeline.get_eval_loss_dict(step=step)
-            eval_loss = functools.reduce(torch.add, eval_loss_dict.values())
+            eval_loss = _sum_losses(eval_loss_dict)
             writer.put_scalar(name="Eval Loss", scalar=eval_loss, step=step)
             writer.put_dict(name="Eval Loss Dict", scalar_dict=eval_loss_dict, step=step)
             writer.put_dict(name="Eval Metrics Dict", scalar_dict=eval_metrics_dict, step=step)
 
         # one eval image
-        if step_check(step, self.config.steps_per_eval_image):
+        if eval_image:
             with TimeWriter(writer, EventName.TEST_RAYS_PER_SEC, write=False) as test_t:
                 metrics_dict, images_dict = self.pipeline.get_eval_image_metrics_and_images(step=step)
             writer.put_time(
@@ -535,6 +1034,9 @@ class Trainer:
                 writer.put_image(name=group + "/" + image_name, image=image, step=step)
 
         # all eval images
-        if step_check(step, self.config.steps_per_eval_all_images):
+        if eval_all_images:
             metrics_dict = self.pipeline.get_average_eval_image_metrics(step=step)
             writer.put_dict(name="Eval Images Metrics Dict (all images)", scalar_dict=metrics_dict, step=step)
+            # rendering all images leaves large blocks in the cache that training does not reuse
+            if self._device_type == "cuda" and self.config.steps_per_empty_cache > 0:
+                torch.cuda.empty_cache()
@@ -17,26 +17,46 @@ Abstracts for the Pipeline class.
 """
 from __future__ import annotations
 
+import os
 import typing
 from abc import abstractmethod
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from pathlib import Path
 from time import time
-from typing import Any, Dict, List, Literal, Mapping, Optional, Tuple, Type, Union, cast
+from typing import (
+    Any,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import torch
 import torch.distributed as dist
-from PIL import Image
 from rich.progress import (
     BarColumn,
     MofNCompleteColumn,
     Progress,
+    TaskID,
     TextColumn,
     TimeElapsedColumn,
     TaskProgressColumn,
 )
 from torch import nn
 from torch.nn import Parameter
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.cuda.amp.grad_scaler import GradScaler
 
@@ -52,7 +72,6 @@ from nerfstudio.models.base_model import Model, ModelConfig
 from nerfstudio.utils import profiler
 from nerfstudio.cameras.rays import RayBundle
 
-import cv2
 import numpy as np
 
 def module_wrapper(ddp_or_model: Union[DDP, Model]) -> Model:
@@ -64,6 +83,115 @@ def module_wrapper(ddp_or_model: Union[DDP, Model]) -> Model:
     return ddp_or_model
 
 
+# opencv expects the camera looking down +z with y down, nerfstudio cameras use -z and y up
+_OPENCV_FLIP = np.diag([1.0, -1.0, -1.0])
+
+
+def _corners_from_aabb(aabb: np.ndarray) -> np.ndarray:
+    """Returns the 8 corners of an axis aligned box, in the order expected by the eval mask code.
+
+    Args:
+        aabb: (2, 3) array with the min and max corners of the box.
+    """
+    ((xmin, ymin, zmin), (xmax, ymax, zmax)) = aabb
+    return np.array([
+        [xmin, ymin, zmin],
+        [xmin, ymax, zmin],
+        [xmax, ymax, zmin],
+        [xmax, ymin, zmin],
+        [xmin, ymin, zmax],
+        [xmin, ymax, zmax],
+        [xmax, ymax, zmax],
+        [xmax, ymin, zmax],
+    ], dtype=np.double)
+
+
+def _images_to_host(
+    images_dict: Dict[str, torch.Tensor],
+    host_buffers: Dict[str, torch.Tensor],
+    stream: Optional[torch.cuda.Stream],
+) -> Dict[str, np.ndarray]:
+    """Quantizes eval images to uint8 on their device and copies them all to host with a single sync.
+
+    The copies go into host buffers that are reused across calls (pinned on cuda) and are issued back to back
+    on ``stream``. "depth_raw" keeps its float values.
+
+    Args:
+        images_dict: images returned by the model, in [0, 1] except for "depth_raw".
+        host_buffers: host tensors reused across calls, keyed like images_dict. Updated in place.
+        stream: side stream to issue the copies on, None when not on cuda.
+
+    Returns:
+        Numpy views of the host buffers, in the order of images_dict. They are overwritten by the next call.
+    """
+    if stream is not None:
+        # run after the work that produced the images, once inside the context the current stream is stream itself
+        stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream) if stream is not None else nullcontext():
+        for key, val in images_dict.items():
+            if key != "depth_raw":
+                val = val.mul(255).clamp_(0, 255).to(torch.uint8)
+            buffer = host_buffers.get(key)
+            if buffer is None or buffer.shape != val.shape or buffer.dtype != val.dtype:
+                buffer = torch.empty(val.shape, dtype=val.dtype, pin_memory=stream is not None)
+                host_buffers[key] = buffer
+            buffer.copy_(val, non_blocking=stream is not None)
+    if stream is not None:
+        stream.synchronize()
+    return {key: host_buffers[key].numpy() for key in images_dict}
+
+
+_T = TypeVar("_T")
+
+
+def _prefetch(iterable: Iterable[_T], depth: int = 2) -> Iterator[_T]:
+    """Yields the items of an iterable while a background thread loads up to ``depth`` items ahead.
+
+    Args:
+        iterable: iterable to load from, only advanced from the background thread.
+        depth: number of items loaded ahead of the consumer.
+    """
+    iterator = iter(iterable)
+    end = object()
+
+    def load_next() -> Any:
+        # grad mode is thread local, the consumer's no_grad does not reach this thread
+        with torch.no_grad():
+            return next(iterator, end)
+
+    # a single worker keeps the loads in order
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        futures = deque(pool.submit(load_next) for _ in range(depth))
+        while True:
+            item = futures.popleft().result()
+            if item is end:
+                return
+            futures.append(pool.submit(load_next))
+            yield item
+
+
+def _add_speed_metrics(metrics_dict: Dict[str, Any], num_rays: int, elapsed: float) -> None:
+    """Adds the rendering speed of one eval image to its metrics.
+
+    Args:
+        metrics_dict: metrics of the image, updated in place.
+        num_rays: number of rays rendered for the image.
+        elapsed: seconds taken to render and evaluate the image.
+    """
+    assert "num_rays_per_sec" not in metrics_dict
+    metrics_dict["num_rays_per_sec"] = num_rays / elapsed
+    assert "fps" not in metrics_dict
+    metrics_dict["fps"] = 1.0 / elapsed
+
+
+def _save_image(array: np.ndarray, path: Path) -> None:
+    """Encodes and writes a uint8 image, run on the eval io pool."""
+    from PIL import Image  # only needed when saving eval renders
+
+    # png stays lossless at any level, level 1 encodes several times faster than the default 6
+    Image.fromarray(array).save(path, compress_level=1)
+
+
 class Pipeline(nn.Module):
     """The intent of this class is to provide a higher level interface for the Model
     that will be easy to use for our Trainer class.
@@ -101,10 +229,19 @@ class Pipeline(nn.Module):
     _model: Model
     world_size: int
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name == "_model":
+            # kept in __dict__ directly so nn.Module does not register the model a second time
+            self.__dict__["_unwrapped_model"] = module_wrapper(value)
+
     @property
     def model(self):
         """Returns the unwrapped model if in ddp"""
-        return module_wrapper(self._model)
+        unwrapped_model = self.__dict__.get("_unwrapped_model")
+        if unwrapped_model is None:
+            return module_wrapper(self._model)
+        return unwrapped_model
 
     @property
     def device(self):
@@ -114,20 +251,23 @@ class Pipeline(nn.Module):
     def load_state_dict(self, state_dict: Mapping[str, Any], strict: Optional[bool] = None):
         is_ddp_model_state = True
         model_state = {}
+        pipeline_state = {}
+        # split the model and pipeline entries in a single pass
         for key, value in state_dict.items():
             if key.startswith("_model."):
                 # remove the "_model." prefix from key
-                model_state[key[len("_model.") :]] = value
+                model_key = key[len("_model.") :]
+                model_state[model_key] = value
                 # make sure that the "module." prefix comes from DDP,
                 # rather than an attribute of the model named "module"
-                if not key.startswith("_model.module."):
+                if is_ddp_model_state and not model_key.startswith("module."):
                     is_ddp_model_state = False
+            else:
+                pipeline_state[key] = value
         # remove "module." prefix added by DDP
-        if is_ddp_model_state:
+        if is_ddp_model_state and model_state:
             model_state = {key[len("module.") :]: value for key, value in model_state.items()}
 
-        pipeline_state = {key: value for key, value in state_dict.items() if not key.startswith("_model.")}
-
         # # hardcoded assuming the first image is used as train set for the 2nd round training, TODO: make it a parameter 
         # model_state['field.embedding_appearance.embedding.weight'] = model_state['field.embedding_appearance.embedding.weight'][0:1, :] 
 
@@ -187,6 +327,7 @@ class Pipeline(nn.Module):
         return model_outputs, loss_dict, metrics_dict
 
     @profiler.time_function
+    @torch.no_grad()
     def get_eval_loss_dict(self, step: int):
         """This function gets your evaluation loss dict. It needs to get the data
         from the DataManager and feed it to the model's forward function
@@ -261,6 +402,16 @@ class VanillaPipelineConfig(cfg.InstantiateConfig):
     """specifies the datamanager config"""
     model: ModelConfig = ModelConfig()
     """specifies the model config"""
+    mixed_precision: bool = False
+    """Whether to run the model forward and loss computation under bfloat16 autocast. bfloat16 keeps the fp32
+    exponent range, so no gradient scaling is needed and the trainer's fp16 grad scaler can stay disabled."""
+    ddp_static_graph: bool = False
+    """Whether to tell DDP that the set of used parameters is the same every step, which lets it skip the unused
+    parameter search after each backward. Off by default since proposal networks and appearance embeddings are
+    not used on every step; only enable it for models that use every parameter each step."""
+    ddp_bf16_compress: bool = False
+    """Whether to all-reduce gradients in bfloat16 with DDP, halving the communication volume on slow
+    interconnects."""
 
 
 class VanillaPipeline(Pipeline):
@@ -323,7 +474,18 @@ class VanillaPipeline(Pipeline):
 
         self.world_size = world_size
         if world_size > 1:
-            self._model = typing.cast(Model, DDP(self._model, device_ids=[local_rank], find_unused_parameters=True))
+            # gradients are views into the DDP buckets, avoiding a copy in each direction per step
+            # a static graph handles unused parameters once, instead of searching for them every step
+            ddp_model = DDP(
+                self._model,
+                device_ids=[local_rank],
+                find_unused_parameters=not config.ddp_static_graph,
+                gradient_as_bucket_view=True,
+                static_graph=config.ddp_static_graph,
+            )
+            if config.ddp_bf16_compress:
+                ddp_model.register_comm_hook(state=None, hook=default_hooks.bf16_compress_hook)
+            self._model = typing.cast(Model, ddp_model)
             dist.barrier(device_ids=[local_rank])
 
     @property
@@ -331,6 +493,16 @@ class VanillaPipeline(Pipeline):
         """Returns the device that the model is on."""
         return self.model.device
 
+    def _autocast(self) -> ContextManager[Any]:
+        """Returns the autocast context used around the model forward and losses.
+
+        When disabled, no autocast context is entered at all, since a disabled one would also switch off the
+        trainer's fp16 autocast around it.
+        """
+        if not self.config.mixed_precision:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+
     @profiler.time_function
     def get_train_loss_dict(self, step: int):
         """This function gets your training loss dict. This will be responsible for
@@ -341,7 +513,8 @@ class VanillaPipeline(Pipeline):
             step: current iteration step to update sampler if using DDP (distributed)
         """
         ray_bundle, batch = self.datamanager.next_train(step)
-        model_outputs = self._model(ray_bundle)  # train distributed data parallel model if world_size > 1
+        with self._autocast():
+            model_outputs = self._model(ray_bundle)  # train distributed data parallel model if world_size > 1
         #print(model_outputs['rgb'].shape) # torch.Size([4096, 3])
         #print(batch)
         '''
@@ -374,8 +547,9 @@ class VanillaPipeline(Pipeline):
         # 6. Could modify the loss function!
 
 
-        metrics_dict = self.model.get_metrics_dict(model_outputs, batch)
-        loss_dict = self.model.get_loss_dict(model_outputs, batch, metrics_dict)
+        with self._autocast():
+            metrics_dict = self.model.get_metrics_dict(model_outputs, batch)
+            loss_dict = self.model.get_loss_dict(model_outputs, batch, metrics_dict)
 
         return model_outputs, loss_dict, metrics_dict
 
@@ -387,6 +561,7 @@ class VanillaPipeline(Pipeline):
         raise NotImplementedError
 
     @profiler.time_function
+    @torch.no_grad()
     def get_eval_loss_dict(self, step: int) -> Tuple[Any, Dict[str, Any], Dict[str, Any]]:
         """This function gets your evaluation loss dict. It needs to get the data
         from the DataManager and feed it to the model's forward function
@@ -396,12 +571,31 @@ class VanillaPipeline(Pipeline):
         """
         self.eval()
         ray_bundle, batch = self.datamanager.next_eval(step)
-        model_outputs = self.model(ray_bundle)
-        metrics_dict = self.model.get_metrics_dict(model_outputs, batch)
-        loss_dict = self.model.get_loss_dict(model_outputs, batch, metrics_dict)
+        with self._autocast():
+            model_outputs = self.model(ray_bundle)
+            metrics_dict = self.model.get_metrics_dict(model_outputs, batch)
+            loss_dict = self.model.get_loss_dict(model_outputs, batch, metrics_dict)
         self.train()
         return model_outputs, loss_dict, metrics_dict
     
+    @torch.no_grad()
+    def surface_detection_forward(self, ray_bundle: RayBundle) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the depth and color of the surface hit by each ray, leaving the train/eval mode untouched.
+
+        Callers querying many ray bundles should switch the pipeline to eval mode once around the loop
+        instead of using get_surface_detection, which toggles the mode of every submodule on each call.
+
+        Args:
+            ray_bundle: ray bundle to pass to model
+        """
+        # TODO：which depth to use?
+        model_outputs = self.model(ray_bundle) # depth / expected_depth / prop_depth_0 / prop_depth_1
+        depth = model_outputs["depth"]
+
+        # also sample the corresponding color
+        color = model_outputs["rgb"]
+        return depth, color
+
     #new function
     @profiler.time_function
     def get_surface_detection(self, step: int, ray_bundle: RayBundle) -> Tuple[Any]:
@@ -412,13 +606,7 @@ class VanillaPipeline(Pipeline):
             ray_bundle: ray bundle to pass to model
         """
         self.eval()
-        # TODO：which depth to use?
-        with torch.no_grad():
-            model_outputs = self.model(ray_bundle) # depth / expected_depth / prop_depth_0 / prop_depth_1
-            depth = model_outputs["depth"]
-
-            # also sample the corresponding color
-            color = model_outputs["rgb"] 
+        depth, color = self.surface_detection_forward(ray_bundle)
         
         '''
         RayBundle(origins=tensor([0.2350, 0.7207, 0.0918], device='cuda:0'), directions=tensor([-0.5048, -0.4801, -0.7174], device='cuda:0'), pixel_area=tensor([1.4408e-06], device='cuda:0'), camera_indices=tensor([0], device='cuda:0'), nears=None, fars=None, metadata={'directions_norm': tensor([1.0684], device='cuda:0')}, times=None)
@@ -433,6 +621,7 @@ class VanillaPipeline(Pipeline):
 
 
     @profiler.time_function
+    @torch.no_grad()
     def get_eval_image_metrics_and_images(self, step: int):
         """This function gets your evaluation loss dict. It needs to get the data
         from the DataManager and feed it to the model's forward function
@@ -452,6 +641,7 @@ class VanillaPipeline(Pipeline):
         return metrics_dict, images_dict
 
     @profiler.time_function
+    @torch.no_grad()
     def get_average_eval_image_metrics(
         self, step: Optional[int] = None, output_path: Optional[Path] = None, get_std: bool = False
     ):
@@ -466,7 +656,6 @@ class VanillaPipeline(Pipeline):
             metrics_dict: dictionary of metrics
         """
         self.eval()
-        metrics_dict_list = []
         assert isinstance(self.datamanager, (VanillaDataManager, ParallelDataManager))
         num_images = len(self.datamanager.fixed_indices_eval_dataloader)
         with Progress(
@@ -481,120 +670,175 @@ class VanillaPipeline(Pipeline):
             # transient=True,
         ) as progress:
             task = progress.add_task("[green]Evaluating all eval images...", total=num_images)
-            # for camera_ray_bundle, batch in self.datamanager.fixed_indices_eval_dataloader:            
-            for image_idx, (camera_ray_bundle, batch) in enumerate(self.datamanager.fixed_indices_eval_dataloader):                # time this the following line
+            if output_path is None:
+                metric_columns = self._eval_loop(progress, task)
+            else:
+                metric_columns = self._eval_loop_with_saves(progress, task, output_path)
+        # average the metrics, all metrics at once as one (num_images, num_metrics) tensor
+        keys = list(metric_columns.keys())
+        columns = []
+        for key in keys:
+            column = metric_columns[key]
+            if all(torch.is_tensor(value) for value in column):
+                # tensor metrics are stacked where they live and copied to host once per metric
+                columns.append(torch.stack([value.detach().reshape(()) for value in column]).to("cpu", torch.float64))
+            else:
+                columns.append(torch.tensor([float(value) for value in column], dtype=torch.float64))
+        values = torch.stack(columns, dim=1)
+        metrics_dict = {}
+        if get_std:
+            key_stds, key_means = torch.std_mean(values, dim=0)
+            for key, key_mean, key_std in zip(keys, key_means.tolist(), key_stds.tolist()):
+                metrics_dict[key] = key_mean
+                metrics_dict[f"{key}_std"] = key_std
+        else:
+            metrics_dict = dict(zip(keys, values.mean(dim=0).tolist()))
+        self.train()
+        return metrics_dict
+
+    def _eval_loop(self, progress: Progress, task: TaskID) -> Dict[str, List[Any]]:
+        """Renders every eval image and returns its metrics, as one list per metric with a value for each image.
+
+        Args:
+            progress: progress bar to advance after each image
+            task: progress bar task of the evaluation
+        """
+        metric_columns: Dict[str, List[Any]] = defaultdict(list)
+        # ray generation and image loading for the next images overlap with the current render
+        for camera_ray_bundle, batch in _prefetch(self.datamanager.fixed_indices_eval_dataloader):
+            inner_start = time()
+            height, width = camera_ray_bundle.shape
+            outputs = self.model.get_outputs_for_camera_ray_bundle(camera_ray_bundle)
+            metrics_dict, _ = self.model.get_image_metrics_and_images(outputs, batch)
+            _add_speed_metrics(metrics_dict, height * width, time() - inner_start)
+            for key, value in metrics_dict.items():
+                metric_columns[key].append(value)
+            progress.advance(task)
+        return metric_columns
+
+    def _eval_loop_with_saves(self, progress: Progress, task: TaskID, output_path: Path) -> Dict[str, List[Any]]:
+        """Same as _eval_loop, and also saves the renders, raw depths and bbox masks of every image.
+
+        Args:
+            progress: progress bar to advance after each image
+            task: progress bar task of the evaluation
+            output_path: path to save rendered images to
+        """
+        import cv2  # only needed when saving eval renders
+
+        metric_columns: Dict[str, List[Any]] = defaultdict(list)
+        eval_cameras = self.datamanager.fixed_indices_eval_dataloader.input_dataset.cameras
+        # the box is the same for every image
+        # TODO: change to oriented box if necessary
+        obb = _corners_from_aabb(self.datamanager.object_aabb.cpu().numpy()) # TODO bzs
+        host_buffers: Dict[str, torch.Tensor] = {}
+        copy_stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+        # png encoding releases the GIL, encode the previous image while the next one renders
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as io_pool:
+            save_futures: List[Future] = []
+            # ray generation and image loading for the next images overlap with the current render
+            eval_data = _prefetch(self.datamanager.fixed_indices_eval_dataloader)
+            for image_idx, (camera_ray_bundle, batch) in enumerate(eval_data):
                 inner_start = time()
                 height, width = camera_ray_bundle.shape
-                num_rays = height * width
                 outputs = self.model.get_outputs_for_camera_ray_bundle(camera_ray_bundle)
                 metrics_dict, images_dict = self.model.get_image_metrics_and_images(outputs, batch)
 
-                if output_path is not None:
-                    camera_indices = camera_ray_bundle.camera_indices
-                    assert camera_indices is not None
-                    filename = self.datamanager.fixed_indices_eval_dataloader.input_dataset.image_filenames[image_idx]
-                    filename = filename.stem # don't want extension
-                    # TODO: change to oriented box if necessary
-                    obb = self.datamanager.object_aabb.cpu().numpy().astype(np.double) # TODO bzs
-                    ((xmin, ymin, zmin), (xmax, ymax, zmax)) = obb
-                    obb = np.array([
-                        [xmin, ymin, zmin],
-                        [xmin, ymax, zmin],
-                        [xmax, ymax, zmin],
-                        [xmax, ymin, zmin],
-                        [xmin, ymin, zmax],
-                        [xmin, ymax, zmax],
-                        [xmax, ymax, zmax],
-                        [xmax, ymin, zmax],
-                    ]).astype(np.double)
-                    T = self.datamanager.fixed_indices_eval_dataloader.input_dataset.cameras[image_idx].camera_to_worlds.cpu().numpy().astype(np.double)
-                    fx = self.datamanager.fixed_indices_eval_dataloader.input_dataset.cameras[image_idx].fx.flatten()
-                    fy = self.datamanager.fixed_indices_eval_dataloader.input_dataset.cameras[image_idx].fy.flatten()
-                    cy = self.datamanager.fixed_indices_eval_dataloader.input_dataset.cameras[image_idx].cy.flatten()
-                    cx = self.datamanager.fixed_indices_eval_dataloader.input_dataset.cameras[image_idx].cx.flatten()
-                    fx = float(fx)
-                    fy = float(fy)
-                    cy = float(cy)
-                    cx = float(cx)
-                    K = np.array([
-                        [fx, 0, cx],
-                        [0, fy, cy],
-                        [0, 0,  1],
-                    ]).astype(np.double)
-                    print(f"{obb=}")
-                    print(f"{T=}")
-                    w2c_R = T[:3, :3].T
-                    w2c_R[1:, :] *= -1 # flip y and z:
-                    w2c_T = -w2c_R @ T[:3, -1]
-                    w2c_R = w2c_R.astype(np.double)
-                    w2c_T = w2c_T.astype(np.double)
-                    print(f"{w2c_R=}")
-                    print(f"{w2c_T=}")
-                    try:
-                        uv, _ = cv2.projectPoints(obb.astype(np.double), w2c_R, w2c_T, K, None)
-                        uv = uv.reshape((-1,2))
-                        print(f"{uv=}")
-                    except Exception as e:
-                        print(e.with_traceback())
-                        uv = None
-                    for key, val in images_dict.items():
-                        if key == "depth_raw":
-                            # save the depth_raw as a npy file
-                            np.save(output_path / f"{filename}_{key}.npy", val.cpu().numpy())
-                        else:
-                            Image.fromarray((val * 255).byte().cpu().numpy()).save(
-                                # output_path / "{0:06d}-{1}.jpg".format(int(camera_indices[0, 0, 0]), key)
-                                # output_path / f"{filename}_{key}.jpg"
-                                output_path / f"{filename}_{key}.png"
-                            )
-                        if key == "img":  # this is the original + render side by side, render on the right
-                            # save the render on its own for easier inpainting
-                            img = (val * 255).byte().cpu().numpy()
-                            h, w, _ = img.shape
-                            render = img[:, w//2:, :]
-                            h, w, _ = render.shape
-                            Image.fromarray(render).save(
-                                # name in lama format
-                                # output_path / f"{filename.replace('_', '')}_render.png"
-                                output_path / f"{filename.replace('_', '')}.png"
-                            )
-                            if uv is None:
-                                continue
-                            bbox_hull = cv2.convexHull(uv.astype(np.int32))
-                            try:
-                                print(np.sum(bbox_hull))
-                            except Exception:
-                                print("oops")
-                            bbox_mask = np.zeros((h, w), dtype=np.uint8)
-                            cv2.fillPoly(bbox_mask, [bbox_hull], 255, cv2.LINE_AA)
-                            np.putmask(render[..., 0], bbox_mask, 255)
-                            Image.fromarray(render).save(
-                                # name in lama format
-                                output_path / f"{filename.replace('_', '')}_bbox.png"
-                            )
-
-                assert "num_rays_per_sec" not in metrics_dict
-                metrics_dict["num_rays_per_sec"] = num_rays / (time() - inner_start)
-                fps_str = "fps"
-                assert fps_str not in metrics_dict
-                metrics_dict[fps_str] = metrics_dict["num_rays_per_sec"] / (height * width)
-                metrics_dict_list.append(metrics_dict)
-                progress.advance(task)
-        # average the metrics list
-        metrics_dict = {}
-        for key in metrics_dict_list[0].keys():
-            if get_std:
-                key_std, key_mean = torch.std_mean(
-                    torch.tensor([metrics_dict[key] for metrics_dict in metrics_dict_list])
-                )
-                metrics_dict[key] = float(key_mean)
-                metrics_dict[f"{key}_std"] = float(key_std)
-            else:
-                metrics_dict[key] = float(
-                    torch.mean(torch.tensor([metrics_dict[key] for metrics_dict in metrics_dict_list]))
+                camera_indices = camera_ray_bundle.camera_indices
+                assert camera_indices is not None
+                filename = self.datamanager.fixed_indices_eval_dataloader.input_dataset.image_filenames[image_idx]
+                filename = filename.stem # don't want extension
+                camera = eval_cameras[image_idx]
+                # read the pose and intrinsics with a single device to host copy
+                camera_params = (
+                    torch.cat([
+                        camera.camera_to_worlds.flatten(),
+                        camera.fx.flatten(),
+                        camera.fy.flatten(),
+                        camera.cx.flatten(),
+                        camera.cy.flatten(),
+                    ])
+                    .cpu()
+                    .numpy()
+                    .astype(np.double)
                 )
-        self.train()
-        return metrics_dict
+                T = camera_params[:12].reshape(3, 4)
+                fx, fy, cx, cy = camera_params[12:].tolist()
+                K = np.array([
+                    [fx, 0, cx],
+                    [0, fy, cy],
+                    [0, 0,  1],
+                ], dtype=np.double)
+                print(f"{obb=}")
+                print(f"{T=}")
+                w2c_R = _OPENCV_FLIP @ T[:3, :3].T
+                w2c_T = -w2c_R @ T[:3, -1]
+                print(f"{w2c_R=}")
+                print(f"{w2c_T=}")
+                try:
+                    # pinhole projection without distortion, same as cv2.projectPoints for 8 corners
+                    uvw = K @ (w2c_R @ obb.T + w2c_T[:, None])
+                    uv = (uvw[:2] / uvw[2]).T
+                    print(f"{uv=}")
+                except Exception as e:
+                    print(e.with_traceback())
+                    uv = None
+                # the host buffers are reused, the previous image must be written before they are overwritten
+                for future in save_futures:
+                    future.result()
+                save_futures.clear()
+                for key, val in _images_to_host(images_dict, host_buffers, copy_stream).items():
+                    if key == "depth_raw":
+                        # save the depth_raw as a npy file
+                        save_futures.append(io_pool.submit(np.save, output_path / f"{filename}_{key}.npy", val))
+                    else:
+                        save_futures.append(io_pool.submit(
+                            _save_image,
+                            val,
+                            # output_path / "{0:06d}-{1}.jpg".format(int(camera_indices[0, 0, 0]), key)
+                            # output_path / f"{filename}_{key}.jpg"
+                            output_path / f"{filename}_{key}.png",
+                        ))
+                    if key == "img":  # this is the original + render side by side, render on the right
+                        # save the render on its own for easier inpainting
+                        h, w, _ = val.shape
+                        render = val[:, w//2:, :]
+                        h, w, _ = render.shape
+                        save_futures.append(io_pool.submit(
+                            _save_image,
+                            render,
+                            # name in lama format
+                            # output_path / f"{filename.replace('_', '')}_render.png"
+                            output_path / f"{filename.replace('_', '')}.png",
+                        ))
+                        if uv is None:
+                            continue
+                        bbox_hull = cv2.convexHull(uv.astype(np.int32))
+                        try:
+                            print(np.sum(bbox_hull))
+                        except Exception:
+                            print("oops")
+                        # the hull is convex by construction; opencv can't draw into the strided red channel view,
+                        # so it is rasterized into a mask first
+                        bbox_mask = np.zeros((h, w), dtype=np.uint8)
+                        cv2.fillConvexPoly(bbox_mask, bbox_hull, 255, cv2.LINE_AA)
+                        # the pending saves above still read the host buffer
+                        render = render.copy()
+                        np.putmask(render[..., 0], bbox_mask, 255)
+                        save_futures.append(io_pool.submit(
+                            _save_image,
+                            render,
+                            # name in lama format
+                            output_path / f"{filename.replace('_', '')}_bbox.png",
+                        ))
+
+                _add_speed_metrics(metrics_dict, height * width, time() - inner_start)
+                for key, value in metrics_dict.items():
+                    metric_columns[key].append(value)
+                progress.advance(task)
+            for future in save_futures:
+                future.result()
+        return metric_columns
 
     def load_pipeline(self, loaded_state: Dict[str, Any], step: int) -> None:
         """Load the checkpoint from the given path
@@ -21,6 +21,7 @@ from __future__ import annotations
 # import random
 import socket
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from typing import Any, Callable, Literal, Optional
 
@@ -31,12 +32,13 @@ import torch
 import tyro
 import yaml
 
+from nerfstudio.cameras.cameras import Cameras
 from nerfstudio.configs.config_utils import convert_markup_to_ansi
 from nerfstudio.configs.method_configs import AnnotatedBaseConfigUnion
-from nerfstudio.engine.trainer import TrainerConfig
+from nerfstudio.engine.trainer import TrainerConfig, latest_checkpoint_step, load_checkpoint_state
+from nerfstudio.pipelines.base_pipeline import Pipeline
 from nerfstudio.utils import comms, profiler
 from nerfstudio.utils.rich_utils import CONSOLE
-import matplotlib.pyplot as plt
 # import dataclasses
 # import functools
 import os
@@ -64,11 +66,8 @@ from nerfstudio.model_components.ray_generators import RayGenerator_surface_dete
 # from rich.panel import Panel
 # from rich.table import Table
 from torch.cuda.amp.grad_scaler import GradScaler
-from sklearn.linear_model import LinearRegression,TheilSenRegressor, HuberRegressor
 import numpy as np
 
-import matplotlib.pyplot as plt
-# from mpl_toolkits.mplot3d import Axes3D
 from itertools import compress
 
 from nerfstudio.data.utils.data_utils import get_depth_image_from_path
@@ -77,11 +76,18 @@ from nerfstudio.data.datasets.depth_dataset import DepthDataset
 
 DEFAULT_TIMEOUT = timedelta(minutes=30)
 
+# the 12 edges of a bbox with vertices in the order of the aabb vertices in plane_estimation, grouped by the axis they
+# run along (x, y, z)
+_BBOX_EDGE_STARTS = np.array([0, 1, 2, 3, 0, 1, 4, 5, 0, 2, 4, 6])
+_BBOX_EDGE_ENDS = np.array([4, 5, 6, 7, 2, 3, 6, 7, 1, 3, 5, 7])
+_BBOX_EDGE_AXIS = np.repeat(np.arange(3), 4)
+for _edge_array in (_BBOX_EDGE_STARTS, _BBOX_EDGE_ENDS, _BBOX_EDGE_AXIS):
+    _edge_array.setflags(write=False)
+
 # speedup for when input size to model doesn't change (much)
 torch.backends.cudnn.benchmark = True  # type: ignore
 
 # new
-import scipy
 
 def _find_free_port() -> str:
     """Finds a free port."""
@@ -133,45 +139,108 @@ def transform_yx(yx, transform, center):
     yx = yx + center
     return yx
 
-def plane_estimation(config: TrainerConfig):
-    config.setup(local_rank=0, world_size=1)
-    pipeline = config.pipeline.setup(device = "cuda", load_dir=config.load_dir)
-    # optimizers = Optimizers(config.optimizers.copy(), pipeline.get_param_groups())
-    grad_scaler = GradScaler(enabled=True)
+def unproject_to_world(
+    yx: torch.Tensor, depth: torch.Tensor, camera_indices: torch.Tensor, cameras: Cameras
+) -> torch.Tensor:
+    """Unprojects pixels with their rendered depth to world coordinates in one batched op.
 
-    # load in the checkpoint
+    Args:
+        yx: (N, 2) pixel coordinates as (row, col)
+        depth: (N,) depth rendered along the ray of each pixel
+        camera_indices: (N,) index of the camera each pixel was sampled from
+        cameras: cameras that camera_indices refer to
+
+    Returns:
+        (N, 3) coordinates of the pixels in world space
+    """
+    device = depth.device
+    camera_indices = camera_indices.to(device)
+    fx = cameras.fx.to(device)[camera_indices, 0]
+    fy = cameras.fy.to(device)[camera_indices, 0]
+    cx = cameras.cx.to(device)[camera_indices, 0]
+    cy = cameras.cy.to(device)[camera_indices, 0]
+    c2w = cameras.camera_to_worlds.to(device)[camera_indices]  # (N, 3, 4)
+
+    x = yx[:, 1].to(device)
+    y = yx[:, 0].to(device)
+    # xyz in camera coordinates
+    X = (x - cx) * depth / fx
+    Y = -(y - cy) * depth / fy
+    Z = -depth
+    camera_xyz = torch.stack([X, Y, Z], dim=-1)  # (N, 3)
+    # rotate and translate in one fused batched addmm instead of building homogeneous coordinates
+    return torch.baddbmm(c2w[:, :, 3:], c2w[:, :, :3], camera_xyz[:, :, None]).squeeze(-1)
+
+def fit_plane(
+    points: torch.Tensor, weights: torch.Tensor, epsilon: float = 1.35, num_iterations: int = 20
+) -> torch.Tensor:
+    """Robustly fits the plane ax + by + cz = 1 to weighted points on their device.
+
+    Outliers are down-weighted with iteratively reweighted least squares on the Huber loss, so each
+    iteration is a single closed-form solve.
+
+    Args:
+        points: (N, 3) points to fit the plane to
+        weights: (N,) per-point sample weights
+        epsilon: residuals larger than epsilon times the residual scale are treated as outliers
+        num_iterations: number of reweighting iterations
+
+    Returns:
+        (3,) plane coefficients (a, b, c)
+    """
+    target = torch.ones_like(points[:, :1])
+    sample_weights = weights.reshape(-1, 1)
+    huber_weights = torch.ones_like(sample_weights)
+    coef = torch.zeros_like(points[0]).unsqueeze(-1)
+    for _ in range(num_iterations):
+        sqrt_weights = torch.sqrt(sample_weights * huber_weights)
+        coef = torch.linalg.lstsq(points * sqrt_weights, target * sqrt_weights).solution
+        residuals = (points @ coef - target).abs()
+        # median absolute deviation as a robust estimate of the residual scale
+        scale = (1.4826 * residuals.median()).clamp_min(1e-12)
+        huber_weights = (epsilon * scale / residuals.clamp_min(1e-12)).clamp_max(1.0)
+    return coef.squeeze(-1)
+
+def load_checkpoint(config: TrainerConfig, pipeline: Pipeline, grad_scaler: GradScaler) -> None:
+    """Loads the pipeline and gradient scaler from the checkpoint selected by the config.
+
+    Goes through load_checkpoint_state, so checkpoints written with ckpt_tensor_format="npz" or ckpt_batch_size > 1
+    load the same way as plain ones.
+
+    Args:
+        config: config holding load_dir and load_step, or load_checkpoint
+        pipeline: pipeline to load the weights into
+        grad_scaler: gradient scaler to load the state into
+    """
     load_dir = config.load_dir
     load_checkpoint = config.load_checkpoint
     if load_dir is not None:
         load_step = config.load_step
         if load_step is None:
             print("Loading latest Nerfstudio checkpoint from load_dir...")
-            # NOTE: this is specific to the checkpoint name format
-            load_step = sorted(int(x[x.find("-") + 1 : x.find(".")]) for x in os.listdir(load_dir))[-1]
+            load_step = latest_checkpoint_step(load_dir)
         load_path: Path = load_dir / f"step-{load_step:09d}.ckpt"
-        assert load_path.exists(), f"Checkpoint {load_path} does not exist"
-        loaded_state = torch.load(load_path, map_location="cpu")
-        _start_step = loaded_state["step"] + 1
-        # load the checkpoints for pipeline, optimizers, and gradient scalar
-        pipeline.load_pipeline(loaded_state["pipeline"], loaded_state["step"])
-        # optimizers.load_optimizers(loaded_state["optimizers"])
-        # if "schedulers" in loaded_state and config.load_scheduler:
-        #     optimizers.load_schedulers(loaded_state["schedulers"])
-        grad_scaler.load_state_dict(loaded_state["scalers"])
-        CONSOLE.print(f"Done loading Nerfstudio checkpoint from {load_path}")
     elif load_checkpoint is not None:
-        assert load_checkpoint.exists(), f"Checkpoint {load_checkpoint} does not exist"
-        loaded_state = torch.load(load_checkpoint, map_location="cpu")
-        _start_step = loaded_state["step"] + 1
-        # load the checkpoints for pipeline, optimizers, and gradient scalar
-        pipeline.load_pipeline(loaded_state["pipeline"], loaded_state["step"])
-        #optimizers.load_optimizers(loaded_state["optimizers"])
-        #if "schedulers" in loaded_state and config.load_scheduler:
-            #optimizers.load_schedulers(loaded_state["schedulers"])
-        grad_scaler.load_state_dict(loaded_state["scalers"])
-        CONSOLE.print(f"Done loading Nerfstudio checkpoint from {load_checkpoint}")
+        load_path = load_checkpoint
     else:
         CONSOLE.print("No Nerfstudio checkpoint to load, so training from scratch.")
+        return
+    assert load_path.exists(), f"Checkpoint {load_path} does not exist"
+    loaded_state = load_checkpoint_state(load_path)
+    # load the checkpoints for pipeline and gradient scalar
+    pipeline.load_pipeline(loaded_state["pipeline"], loaded_state["step"])
+    grad_scaler.load_state_dict(loaded_state["scalers"])
+    CONSOLE.print(f"Done loading Nerfstudio checkpoint from {load_path}")
+
+
+def plane_estimation(config: TrainerConfig):
+    config.setup(local_rank=0, world_size=1)
+    pipeline = config.pipeline.setup(device = "cuda", load_dir=config.load_dir)
+    # optimizers = Optimizers(config.optimizers.copy(), pipeline.get_param_groups())
+    grad_scaler = GradScaler(enabled=True)
+
+    # load in the checkpoint
+    load_checkpoint(config, pipeline, grad_scaler)
 
     # generate ray for surface detection from evaluation dataset
     # TODO: avoid "pipeline." prefix
@@ -193,9 +262,16 @@ def plane_estimation(config: TrainerConfig):
 
     pipeline.datamanager.surface_detection_ray_generator = RayGenerator_surface_detection(pipeline.datamanager.train_dataset.cameras.to(pipeline.datamanager.device))
     pipeline.datamanager.surface_detection_camera = pipeline.datamanager.surface_detection_dataset.cameras
+    # read the image sizes of all cameras once instead of indexing a Cameras object per image
+    camera_heights = pipeline.datamanager.surface_detection_camera.height.squeeze(-1).tolist()
+    camera_widths = pipeline.datamanager.surface_detection_camera.width.squeeze(-1).tolist()
 
-    world_xyz = []
+    sample_yx = []
+    sample_depth = []
+    sample_camera_indices = []
     colors = []
+    # switch to eval mode once for all the surface queries below
+    pipeline.eval()
     # HARDCODED for polycam, which means the right direction is actually downwards in the real world
     for i, item in enumerate(pipeline.datamanager.mask):
         mask_array = item['mask'].numpy().squeeze()
@@ -206,12 +282,11 @@ def plane_estimation(config: TrainerConfig):
         min_x = np.min(x)
 
         image_idx = item['image_idx']
-        camera = pipeline.datamanager.surface_detection_camera[image_idx]
         # decide which direction (out of "down", "up", "left", "right") to search for the bottom pixel
         # read depth image
         depth_filepath = pipeline.datamanager.surface_detection_dataset.depth_filenames[item['image_idx']]
-        depth_height = int(camera.height)
-        depth_width = int(camera.width)
+        depth_height = int(camera_heights[image_idx])
+        depth_width = int(camera_widths[image_idx])
         # depth_height: 738
         # depth_width: 994
         depth_image = get_depth_image_from_path(filepath=depth_filepath, height=depth_height, width=depth_width, scale_factor=1.0)
@@ -309,10 +384,13 @@ def plane_estimation(config: TrainerConfig):
 
         candidate_points = np.hstack((idx_array, corner_candidates.reshape(num_candidates, 2)))
         ray_indices = torch.from_numpy(candidate_points).int() # ray_indices.shape: torch.Size([62, 3])
+        # keep the indices on the same device as the ray generator buffers, which are otherwise moved back and forth.
+        # a plain copy: pinning a new buffer this small per image costs more than it saves
+        ray_indices = ray_indices.to(pipeline.datamanager.device)
 
         # create ray bundle from ray indices
         ray_bundle_corner_candidates = pipeline.datamanager.surface_detection_ray_generator(ray_indices)
-        depth_candidates, colors_candidates = pipeline.get_surface_detection(pipeline, ray_bundle_corner_candidates)
+        depth_candidates, colors_candidates = pipeline.surface_detection_forward(ray_bundle_corner_candidates)
         # depth_candidates.shape: torch.Size([62, 1])
         # colors_candidates.shape: torch.Size([62, 3])
 
@@ -384,56 +462,39 @@ def plane_estimation(config: TrainerConfig):
         idx_tensor = torch.full((n_random, 1), image_idx).to(random_points_yx.device)
         random_points = torch.cat([idx_tensor, random_points_yx], dim=1) # (n_random, 3)
         ray_bundle_random = pipeline.datamanager.surface_detection_ray_generator(random_points)
-        depth_random, colors_random = pipeline.get_surface_detection(pipeline, ray_bundle_random)
+        depth_random, colors_random = pipeline.surface_detection_forward(ray_bundle_random)
 
         all_yx = torch.cat([corners, random_points_yx], dim=0) # (n_safe + n_random, 2)
         all_depth = torch.cat([depth_corners, depth_random.squeeze()], dim=0) # (n_safe + n_random,)
         all_colors = torch.cat([colors_corners, colors_random], dim=0) # (n_safe + n_random, 3)
 
-        fx = camera.fx.to(depth_corners.device)
-        fy = camera.fy.to(depth_corners.device)
-        cx = camera.cx.to(depth_corners.device)
-        cy = camera.cy.to(depth_corners.device)
-        c2w = camera.camera_to_worlds.to(depth_corners.device)
-        # fx: tensor([737.9322])
-        # fy: tensor([737.9322])
-        # cx: tensor([499.0845])
-        # cy: tensor([371.1886])
-        # c2w.shape: torch.Size([3, 4])
-
-        # x = corners[:, 1]
-        # y = corners[:, 0]
-        x = all_yx[:, 1]
-        y = all_yx[:, 0]
-
-        # xyz in camera coordinates
-        # X = (x - cx) * depth_corners / fx
-        # Y = -(y - cy) * depth_corners / fy
-        # Z = -depth_corners
-        X = (x - cx) * all_depth / fx
-        Y = -(y - cy) * all_depth / fy
-        Z = -all_depth
-        
-        # Convert to world coordinates
-        camera_xyz = torch.stack([X, Y, Z, torch.ones_like(X)], dim=-1)
-        world_coordinates = (c2w @ camera_xyz.T).T[..., :3]
-
-        world_xyz.append(world_coordinates.cpu().numpy())
+        # defer the unprojection so that all images are handled in a single batched op after the loop
+        sample_yx.append(all_yx)
+        sample_depth.append(all_depth)
+        sample_camera_indices.append(torch.full((all_yx.shape[0],), image_idx, dtype=torch.long))
         # colors.append(colors_corners.cpu().numpy())
-        colors.append(all_colors.cpu().numpy())
-
-    world_xyz_np = np.concatenate(world_xyz, axis=0)
-    colors_np = np.concatenate(colors, axis=0)
+        colors.append(all_colors)
+    pipeline.train()
+
+    world_xyz = unproject_to_world(
+        yx=torch.cat(sample_yx, dim=0),
+        depth=torch.cat(sample_depth, dim=0),
+        camera_indices=torch.cat(sample_camera_indices, dim=0),
+        cameras=pipeline.datamanager.surface_detection_camera,
+    )
+    # keep the colors on the device, they are only copied to the host once for saving
+    colors = torch.cat(colors, dim=0).to(world_xyz)
 
-    # find the median of each column
-    median = np.median(colors_np, axis=0) # (3,)
-    # find the covariance matrix of the colors_np values
-    cov = np.cov(colors_np.T) # (3, 3)
+    # find the median of each column (quantile interpolates like np.median)
+    median = torch.quantile(colors, 0.5, dim=0) # (3,)
+    # find the covariance matrix of the colors values
+    cov = torch.cov(colors.T) # (3, 3)
     # inverse of the covariance matrix
-    cov_inv = np.linalg.inv(cov) # (3, 3)
+    cov_inv = torch.linalg.inv(cov) # (3, 3)
     # find the mahalanobis distance of each point from the median
-    mahalanobis = scipy.spatial.distance.cdist(colors_np, [median], metric='mahalanobis', VI=cov_inv) # (N, 1)
-    mahalanobis_similarity = 1 / (1 + mahalanobis) # (N, 1)
+    diff = colors - median
+    mahalanobis = torch.sqrt(torch.sum((diff @ cov_inv) * diff, dim=-1)) # (N,)
+    mahalanobis_similarity = 1 / (1 + mahalanobis) # (N,)
 
     #     above_bottom_pixel = (y_lower, bottom_pixel[1])
     
@@ -523,82 +584,26 @@ def plane_estimation(config: TrainerConfig):
     # #print(pipeline.datamanager.ray_indices.shape, len(pipeline.datamanager.expanded_cameras))
     # #print(pipeline.datamanager.ray_indices.shape, len(camera_list))
 
-    # output, colors = pipeline.get_surface_detection(pipeline, pipeline.datamanager.ray_bundle_surface_detection)
-    # num_image = len(pipeline.datamanager.expanded_cameras)
-    # assert num_image == len(output) , f"false length"
-
-    # print(f"output.shape: {output.shape}")
-    # print(f"colors.shape: {colors.shape}")
-    # print(f"num_image: {num_image}")
-    # colors = colors.cpu()
-    # # find the median of each column
-    # median = np.median(colors, axis=0) # (3,)
-    # # find the covariance matrix of the colors values
-    # cov = np.cov(colors.T) # (3, 3)
-    # # inverse of the covariance matrix
-    # cov_inv = np.linalg.inv(cov) # (3, 3)
-    # # find the mahalanobis distance of each point from the median
-    # mahalanobis = scipy.spatial.distance.cdist(colors, [median], metric='mahalanobis', VI=cov_inv) # (N, 1)
-    # mahalanobis_similarity = 1 / (1 + mahalanobis) # (N, 1)
-
-    # world_xyz = []
-    # for i in range(num_image):
-        
-    #     fx = pipeline.datamanager.expanded_cameras[i].fx
-    #     fy = pipeline.datamanager.expanded_cameras[i].fy
-    #     cx = pipeline.datamanager.expanded_cameras[i].cx
-    #     cy = pipeline.datamanager.expanded_cameras[i].cy
-    #     c2w = pipeline.datamanager.expanded_cameras[i].camera_to_worlds
-    #     depth = output[i].to(fx.device)
-    #     y = pipeline.datamanager.ray_indices[i][1]
-    #     x = pipeline.datamanager.ray_indices[i][2]
-    #     # xyz in camera coordinates
-    #     X = (x - cx) * depth / fx
-    #     # Y = (y - cy) * depth / fy
-    #     # Z = depth
-    #     Y = -(y - cy) * depth / fy
-    #     Z = -depth
-    #     # Convert to world coordinates
-    #     camera_xyz = torch.stack([X, Y, Z, torch.ones_like(X)], dim=-1)
-    #     c2w = c2w.to(camera_xyz.device)
-    #     #world_xyz.append((c2w @ camera_xyz.T).T[..., :3])
-    #     world_coordinates = (c2w @ camera_xyz.T).T[..., :3]
-    #     world_xyz.append(world_coordinates)
-    
-    # print(len(world_xyz))
-    # # calculate the plane equation using linear regression
-    # # Flatten the world_xyz list and convert it to a numpy array
-    # world_xyz_np = np.concatenate([xyz.cpu().numpy() for xyz in world_xyz], axis=0)
-
-    # Create a LinearRegression object
-    # reg = LinearRegression()
-    # reg = TheilSenRegressor(random_state=0)
-    # use a Huber regressor
-    # reg = HuberRegressor()
-    reg = HuberRegressor(fit_intercept=False)
-
     # filter out points with mahalanobis similarity less than some threshold
     # similarity_threshold = 0.6
     similarity_threshold = 0.5
     # similarity_threshold = 0
-    n_points = world_xyz_np.shape[0]
-    world_xyz_np = world_xyz_np[mahalanobis_similarity.flatten() > similarity_threshold]
-    mahalanobis_similarity = mahalanobis_similarity[mahalanobis_similarity.flatten() > similarity_threshold]
-    print(f"Filtering out points with color mahalanobis similarity less than {similarity_threshold}, number of remaining points: {world_xyz_np.shape[0]}/{n_points}")
+    n_points = world_xyz.shape[0]
+    keep = mahalanobis_similarity > similarity_threshold
+    world_xyz = world_xyz[keep]
+    similarity_weights = mahalanobis_similarity[keep]
+    CONSOLE.print(
+        f"Filtering out points with color mahalanobis similarity less than {similarity_threshold}, "
+        f"number of remaining points: {world_xyz.shape[0]}/{n_points}"
+    )
 
     # Fit the model to the data
     # ax + by + cz + d = 0
-    # reg.fit(world_xyz_np[:, :2], world_xyz_np[:, 2])
-    # reg.fit(world_xyz_np[:, :2], world_xyz_np[:, 2], sample_weight=mahalanobis_similarity.flatten())
-    reg.fit(world_xyz_np, np.ones(world_xyz_np.shape[0]), sample_weight=mahalanobis_similarity.flatten())
-    print(f"Used {reg.__class__.__name__} weighted by mahalanobis similarity")
-
-    # The coefficients a, b are in reg.coef_, and the intercept d is in reg.intercept_
-    # a, b = reg.coef_
-    # d = reg.intercept_
-    # c = -1
-    a, b, c = reg.coef_
+    a, b, c = fit_plane(world_xyz, similarity_weights).tolist()
     d = -1
+    print("Used a Huber plane fit weighted by mahalanobis similarity")
+    world_xyz_np = world_xyz.cpu().numpy()
+    colors_np = colors.cpu().numpy()
 
     # vertices = pipeline.datamanager.vertices
     # print("Vertices of bbox\n")
@@ -630,59 +635,6 @@ def plane_estimation(config: TrainerConfig):
     # object_obb = pipeline.datamanager.object_obb
     # obb_vertices = object_obb.get_corners().cpu().numpy()
     
-    # Create a 3D plot
-    fig = plt.figure()
-    ax = fig.add_subplot(111, projection='3d')
-    ax.set_title('bbox with transformation')
-    ## Plot the points in world_xyz
-    #for xyz in world_xyz:
-    #    ax.scatter(xyz[:, 0], xyz[:, 1], xyz[:, 2])
-
-    # Plot the plane
-    # xx, yy = np.meshgrid(range(-5, 5), range(-5, 5))
-    xx, yy = np.meshgrid(range(-2, 2), range(-2, 2))
-    zz = (-a * xx - b * yy - d) / c
-    ax.plot_surface(xx, yy, zz, alpha=0.5)
-
-    # # plot the reference plane
-    # xx1, yy1 = np.meshgrid(range(-5, 5), range(-5, 5))
-    # zz1 = (0.7365434765815735 * xx1 + 0.14943844079971313 * yy1 + 0.01226318534463644)/(-1)
-    # ax.plot_surface(xx1, yy1, zz1, alpha=0.5, color = 'r')
-
-    
-    #print(vertices.shape) # 8 x 3
-    #TODO: plot the vertices
-    # Plot the vertices
-    # for vertex in vertices:
-    #     ax.scatter(*vertex)
-
-    # Plot the bbox
-    edges = {
-        "x": [(0, 4), (1, 5), (2, 6), (3, 7)],
-        "y": [(0, 2), (1, 3), (4, 6), (5, 7)],
-        "z": [(0, 1), (2, 3), (4, 5), (6, 7)]
-    }
-    # Plot the edges of the bbox
-    for direction, edge_indices in edges.items():
-        for i, j in edge_indices:
-            # Get the starting and ending vertices for this edge
-            starting_vertex = vertices[i]
-            ending_vertex = vertices[j]
-            # Plot the edge
-            ax.plot([starting_vertex[0], ending_vertex[0]], [starting_vertex[1], ending_vertex[1]], 
-                    [starting_vertex[2], ending_vertex[2]], color="red")    
-
-    # # Plot the edges of the obb
-    # for direction, edge_indices in edges.items():
-    #     for i, j in edge_indices:
-    #         # Get the starting and ending vertices for this edge
-    #         starting_vertex = obb_vertices[i]
-    #         ending_vertex = obb_vertices[j]
-    #         # Plot the edge
-    #         ax.plot([starting_vertex[0], ending_vertex[0]], [starting_vertex[1], ending_vertex[1]], 
-    #                 [starting_vertex[2], ending_vertex[2]], color="red")    
-
-    # plt.show()
     
     # The equation of the plane is `ax + by + cz + d = 0`
     CONSOLE.print(f"The points used for the plane equation are: {world_xyz_np}")
@@ -695,6 +647,15 @@ def plane_estimation(config: TrainerConfig):
     if not os.path.exists(plot_dir):
         os.makedirs(plot_dir)
 
+    bbox_intersections = derive_nsa(a, b, c, d, vertices, dilation_scale=1.3)
+
+    # render the optional 3D plot in the background while the remaining outputs are written
+    plot_future = None
+    if config.enable_surface_plot:
+        plot_path = os.path.join(plot_dir, f"nsa_plot.png")
+        plot_pool = ThreadPoolExecutor(max_workers=1)
+        plot_future = plot_pool.submit(save_surface_plot, (a, b, c, d), vertices, bbox_intersections, plot_path)
+
     # save the object occupancy grid as npy file
     occupancy_path = os.path.join(plot_dir, f"object_occupancy.npy")
     np.save(occupancy_path, object_occupancy)
@@ -716,7 +677,6 @@ def plane_estimation(config: TrainerConfig):
     np.save(aabb_path, object_aabb)
     print(f"Saved the aabb to {aabb_path}")
 
-    bbox_intersections = derive_nsa(a, b, c, d, vertices, dilation_scale=1.3)
     # save the intersections as npy file
     intersections_path = os.path.join(plot_dir, f"aabb_intersections.npy")
     np.save(intersections_path, np.array(bbox_intersections))
@@ -730,80 +690,83 @@ def plane_estimation(config: TrainerConfig):
     # print(f"The obb intersections are: {obb_intersections}")
     # print(f"Saved the obb intersections to {obb_intersections_path}")
 
+    if plot_future is not None:
+        plot_future.result()
+        plot_pool.shutdown(wait=True)
+        CONSOLE.print(f"Saved the NSA plot to {plot_path}")
+
+
+
+def save_surface_plot(plane_coefficients, vertices, intersections, plot_path) -> None:
+    """Saves a 3D plot of the fitted plane, the object bbox and its intersections with the plane.
+
+    Uses a standalone Figure instead of pyplot so that it is safe to call from a worker thread.
+
+    Args:
+        plane_coefficients: (a, b, c, d) of the plane ax + by + cz + d = 0
+        vertices: (8, 3) vertices of the object bbox
+        intersections: intersections of the bbox edges with the plane
+        plot_path: path to save the plot to
+    """
+    # imported lazily so that runs without plotting never load matplotlib
+    from matplotlib.figure import Figure
+
+    a, b, c, d = plane_coefficients
+    fig = Figure()
+    ax = fig.add_subplot(111, projection='3d')
+    ax.set_title('bbox with transformation')
+
+    # Plot the plane
+    xx, yy = np.meshgrid(range(-2, 2), range(-2, 2))
+    zz = (-a * xx - b * yy - d) / c
+    ax.plot_surface(xx, yy, zz, alpha=0.5)
+
+    # Plot the edges of the bbox
+    for starting_vertex, ending_vertex in zip(vertices[_BBOX_EDGE_STARTS], vertices[_BBOX_EDGE_ENDS]):
+        ax.plot([starting_vertex[0], ending_vertex[0]], [starting_vertex[1], ending_vertex[1]],
+                [starting_vertex[2], ending_vertex[2]], color="red")
+
     # plot the intersections in the 3D plot
-    for intersection in bbox_intersections:
+    for intersection in intersections:
         ax.scatter(*intersection, color="green")
 
-    # # plot the obb intersections in the 3D plot
-    # for intersection in obb_intersections:
-    #     ax.scatter(*intersection, color="blue", marker="x")
-
     # save the 3D plot locally
-    plot_path = os.path.join(plot_dir, f"nsa_plot.png")
-    plt.savefig(plot_path)
-    CONSOLE.print(f"Saved the NSA plot to {plot_path}")
-
+    fig.savefig(plot_path)
 
 
 def derive_nsa(a, b, c, d, vertices, dilation_scale=1.0):
-    # Initialize the list of intersections
-    intersections = []
+    """Intersects the edges of the (dilated) bbox with the plane ax + by + cz + d = 0.
 
-    # Define the edges
-    edges = {
-        "x": [(0, 4), (1, 5), (2, 6), (3, 7)],
-        "y": [(0, 2), (1, 3), (4, 6), (5, 7)],
-        "z": [(0, 1), (2, 3), (4, 5), (6, 7)]
-    }
+    Args:
+        a, b, c, d: coefficients of the plane
+        vertices: (8, 3) vertices of the bbox, in the order of the aabb vertices in plane_estimation
+        dilation_scale: scale to dilate the bbox with around its center
 
+    Returns:
+        (M, 3) intersections of the bbox edges with the plane. If no edge intersects the plane, the z edges are
+        projected onto it instead.
+    """
     # Dilate the bbox
     # get the center of the bbox
     center = np.mean(vertices, axis=0)
     vertices = (vertices - center) * dilation_scale + center
 
-    # Iterate over each edge
-    for direction, edge_indices in edges.items():
-        if direction == "x":
-            directional_vector = vertices[4] - vertices[0]
-        elif direction == "y":
-            directional_vector = vertices[2] - vertices[0]
-        else:  # direction == "z"
-            directional_vector = vertices[1] - vertices[0]
-
-        for i, j in edge_indices:
-            # Get the starting vertex and directional vector for this edge
-            starting_vertex = vertices[i]
-
-            # Solve for t
-            t = -(a * starting_vertex[0] + b * starting_vertex[1] + c * starting_vertex[2] + d) / (a * directional_vector[0] + b * directional_vector[1] + c * directional_vector[2])
-
-            # If t is in the range [0, 1], the edge intersects with the plane
-            if 0 <= t <= 1:
-                # Calculate the 3D coordinate of the intersection point
-                intersection = starting_vertex + t * directional_vector
-                # Append the intersection to the list of intersections
-                intersections.append(intersection)
+    # solve starting_vertex + t * directional_vector on the plane for all edges at once
+    normal = np.array([a, b, c])
+    starting_vertices = vertices[_BBOX_EDGE_STARTS]  # (12, 3)
+    directional_vectors = vertices[_BBOX_EDGE_ENDS] - starting_vertices  # (12, 3)
+    # edges parallel to the plane divide by zero and never pass the range check below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = -(starting_vertices @ normal + d) / (directional_vectors @ normal)
 
+    # If t is in the range [0, 1], the edge intersects with the plane
+    intersecting = (t >= 0) & (t <= 1)
     # If no intersections were found, project the bbox along the z axis (strong assumption that the z axis is the vertical axis)
-    if len(intersections) == 0:
+    if not intersecting.any():
         print("No intersection found, will project along the z axis")
-        direction = "z"
-        edge_indices = edges[direction]
-        directional_vector = vertices[1] - vertices[0]
-        for i, j in edge_indices:
-            # Get the starting vertex and directional vector for this edge
-            starting_vertex = vertices[i]
-
-            # Solve for t
-            t = -(a * starting_vertex[0] + b * starting_vertex[1] + c * starting_vertex[2] + d) / (a * directional_vector[0] + b * directional_vector[1] + c * directional_vector[2])
-
-            # Calculate the 3D coordinate of the intersection point
-            intersection = starting_vertex + t * directional_vector
-            # Append the intersection to the list of intersections
-            intersections.append(intersection)
-
-    # Return the list of intersections
-    return intersections
+        intersecting = _BBOX_EDGE_AXIS == 2
+
+    return starting_vertices[intersecting] + t[intersecting, None] * directional_vectors[intersecting]
 
 def main(config: TrainerConfig) -> None:
     """Main function."""
@@ -0,0 +1,213 @@
+"""
+Test the trainer checkpointing
+"""
+from __future__ import annotations
+
+import gc
+import weakref
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from nerfstudio.configs.base_config import MachineConfig
+from nerfstudio.engine.trainer import Trainer, TrainerConfig, load_checkpoint_state
+
+
+class MixedDtypeModel(nn.Module):
+    """Model with float parameters next to integer buffers, like the hash grid fields"""
+
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(4, 2)
+        self.register_buffer("max_res", torch.tensor(2048))
+        self.register_buffer("num_levels", torch.tensor(16))
+        self.register_buffer("mask", torch.tensor([True, False, True]))
+
+
+def make_trainer(tmp_path: Path, **kwargs) -> Trainer:
+    """Builds a cpu trainer with a small model and optimizer instead of a full pipeline"""
+    config = TrainerConfig(
+        method_name="test", output_dir=tmp_path, machine=MachineConfig(device_type="cpu"), **kwargs
+    )
+    trainer = Trainer(config)
+    model = MixedDtypeModel()
+    optimizer = torch.optim.Adam(model.parameters())
+    # take a step so that the optimizer state holds tensors too
+    model.linear(torch.ones(1, 4)).sum().backward()
+    optimizer.step()
+    trainer.pipeline = model  # type: ignore
+    trainer.optimizers = SimpleNamespace(optimizers={"fields": optimizer}, schedulers={})  # type: ignore
+    return trainer
+
+
+def assert_state_equal(loaded, expected):
+    """Checks that a loaded (nested) state matches the saved one"""
+    if isinstance(expected, torch.Tensor):
+        assert isinstance(loaded, torch.Tensor)
+        assert loaded.dtype == expected.dtype
+        assert torch.equal(loaded, expected)
+    elif isinstance(expected, dict):
+        assert loaded.keys() == expected.keys()
+        for key, value in expected.items():
+            assert_state_equal(loaded[key], value)
+    elif isinstance(expected, (list, tuple)):
+        assert len(loaded) == len(expected)
+        for loaded_value, value in zip(loaded, expected):
+            assert_state_equal(loaded_value, value)
+    else:
+        assert loaded == expected
+
+
+def test_checkpoint_round_trip_mixed_dtypes(tmp_path: Path):
+    """Test that a state mixing float and integer tensors survives the staged save"""
+    trainer = make_trainer(tmp_path)
+    trainer.save_checkpoint(step=10)
+    trainer._wait_for_checkpoints()
+
+    loaded_state = load_checkpoint_state(trainer.checkpoint_dir / "step-000000010.ckpt")
+    assert loaded_state["step"] == 10
+    assert_state_equal(loaded_state["pipeline"], trainer.pipeline.state_dict())
+    assert_state_equal(loaded_state["optimizers"]["fields"], trainer.optimizers.optimizers["fields"].state_dict())
+
+
+def test_npz_checkpoint_round_trip_and_rotation(tmp_path: Path):
+    """Test that npz checkpoints are merged back on load and that only the latest one is kept"""
+    trainer = make_trainer(tmp_path, ckpt_tensor_format="npz")
+    trainer.checkpoint_dir.mkdir(parents=True)
+    stale_path = trainer.checkpoint_dir / "step-000000001.ckpt"
+    stale_path.touch()
+    for step in (10, 20, 30):
+        trainer.save_checkpoint(step=step)
+        trainer._opt_steps += 1
+    trainer._wait_for_checkpoints()
+
+    ckpt_path = trainer.checkpoint_dir / "step-000000030.ckpt"
+    assert sorted(trainer.checkpoint_dir.iterdir()) == [ckpt_path, ckpt_path.with_suffix(".npz")]
+    # the torch file only references the pipeline tensors
+    raw_state = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+    assert raw_state["pipeline_tensor_file"] == "step-000000030.npz"
+    assert not raw_state["pipeline"]
+    loaded_state = load_checkpoint_state(ckpt_path)
+    assert loaded_state["step"] == 30
+    assert "pipeline_tensor_file" not in loaded_state
+    assert_state_equal(loaded_state["pipeline"], trainer.pipeline.state_dict())
+
+
+def test_batched_checkpoint_round_trip(tmp_path: Path):
+    """Test that batched snapshots are written as one file and loaded as the latest snapshot"""
+    trainer = make_trainer(tmp_path, ckpt_batch_size=2)
+    trainer.save_checkpoint(step=10)
+    trainer._opt_steps += 1
+    with torch.no_grad():
+        trainer.pipeline.linear.weight.add_(1.0)
+    trainer.save_checkpoint(step=20)
+    trainer._wait_for_checkpoints()
+
+    ckpt_path = trainer.checkpoint_dir / "step-000000020.ckpt"
+    assert list(trainer.checkpoint_dir.iterdir()) == [ckpt_path]
+    raw_state = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+    assert [snapshot["step"] for snapshot in raw_state["snapshots"]] == [10, 20]
+    # each snapshot holds its own copy of the weights
+    assert torch.equal(
+        raw_state["snapshots"][0]["pipeline"]["linear.weight"] + 1.0,
+        raw_state["snapshots"][1]["pipeline"]["linear.weight"],
+    )
+    loaded_state = load_checkpoint_state(ckpt_path)
+    assert loaded_state["step"] == 20
+    assert_state_equal(loaded_state["pipeline"], trainer.pipeline.state_dict())
+
+
+def test_staging_buffers_reused_across_checkpoints(tmp_path: Path):
+    """Test that saves alternate between two staging buffers that are refilled with the current state"""
+    trainer = make_trainer(tmp_path)
+    trainer.save_checkpoint(step=10)
+    first_views = trainer._ckpt_buffers[0][1]
+    for step in (20, 30):
+        trainer._opt_steps += 1
+        with torch.no_grad():
+            trainer.pipeline.linear.weight.add_(1.0)
+        trainer.save_checkpoint(step=step)
+    trainer._wait_for_checkpoints()
+
+    assert trainer._ckpt_buffers[1] is not None
+    assert all(
+        view.data_ptr() == first_view.data_ptr() for view, first_view in zip(trainer._ckpt_buffers[0][1], first_views)
+    )
+    loaded_state = load_checkpoint_state(trainer.checkpoint_dir / "step-000000030.ckpt")
+    assert_state_equal(loaded_state["pipeline"], trainer.pipeline.state_dict())
+
+
+def test_staging_falls_back_to_host_copies_over_limit(tmp_path: Path):
+    """Test that states over ckpt_max_pinned_mb are copied without staging buffers"""
+    trainer = make_trainer(tmp_path, ckpt_max_pinned_mb=0)
+    trainer.save_checkpoint(step=10)
+    trainer._wait_for_checkpoints()
+
+    assert trainer._ckpt_buffers == [None, None]
+    loaded_state = load_checkpoint_state(trainer.checkpoint_dir / "step-000000010.ckpt")
+    assert_state_equal(loaded_state["pipeline"], trainer.pipeline.state_dict())
+    assert_state_equal(loaded_state["optimizers"]["fields"], trainer.optimizers.optimizers["fields"].state_dict())
+
+
+def test_partial_checkpoint_batch_written_after_executor_shutdown(tmp_path: Path):
+    """Test that the exit path writes a partial snapshot batch once the executor refuses new work"""
+    trainer = make_trainer(tmp_path, ckpt_batch_size=3)
+    trainer.save_checkpoint(step=10)
+    trainer._opt_steps += 1
+    trainer.save_checkpoint(step=20)
+    # concurrent.futures shuts its executors down before atexit handlers run
+    trainer._ckpt_executor.shutdown(wait=True)
+    trainer._wait_for_checkpoints(synchronous=True)
+
+    loaded_state = load_checkpoint_state(trainer.checkpoint_dir / "step-000000020.ckpt")
+    assert loaded_state["step"] == 20
+    assert_state_equal(loaded_state["pipeline"], trainer.pipeline.state_dict())
+
+
+def test_trainer_not_kept_alive_by_exit_handler(tmp_path: Path):
+    """Test that registering the checkpoint exit handler does not keep the trainer alive"""
+    trainer = make_trainer(tmp_path)
+    trainer_ref = weakref.ref(trainer)
+    del trainer
+    gc.collect()
+    assert trainer_ref() is None
+
+
+def test_accumulated_gradients_match_per_micro_step_average(tmp_path: Path):
+    """Test that averaging the scaled loss matches dividing each micro-step loss before scaling it"""
+    num_steps = 3
+    torch.manual_seed(0)
+    batches = [torch.randn(8, 4) for _ in range(num_steps)]
+    model = nn.Linear(4, 2)
+    reference_model = nn.Linear(4, 2)
+    reference_model.load_state_dict(model.state_dict())
+
+    # previous implementation: loss /= N inside autocast, then scale(loss).backward()
+    reference_scaler = torch.cuda.amp.GradScaler(enabled=False)
+    for batch in batches:
+        reference_loss = (reference_model(batch) ** 2).mean()
+        reference_loss /= num_steps
+        reference_scaler.scale(reference_loss).backward()
+
+    trainer = make_trainer(tmp_path, gradient_accumulation_steps=num_steps)
+    micro_batches = iter(batches)
+
+    def get_train_loss_dict(step: int):
+        return None, {"loss": (model(next(micro_batches)) ** 2).mean()}, {}
+
+    trainer.pipeline = SimpleNamespace(_model=model, get_train_loss_dict=get_train_loss_dict)  # type: ignore
+    trainer.optimizers = SimpleNamespace(  # type: ignore
+        zero_grad_all=lambda: model.zero_grad(set_to_none=True),
+        # leave the gradients in place to compare them
+        optimizer_scaler_step_all=lambda grad_scaler: None,
+        scheduler_step_all=lambda step: None,
+    )
+    loss, _, _ = trainer.train_iteration(step=0)
+
+    for param, reference_param in zip(model.parameters(), reference_model.parameters()):
+        assert param.grad is not None and reference_param.grad is not None
+        assert torch.allclose(param.grad, reference_param.grad, atol=1e-6)
+    # the logged loss is still the last micro-step's share of the average
+    assert torch.allclose(loss, reference_loss.detach(), atol=1e-6)
@@ -0,0 +1,101 @@
+"""
+Test plane estimation helpers
+"""
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict
+
+import numpy as np
+import torch
+from torch import nn
+from torch.cuda.amp.grad_scaler import GradScaler
+
+from nerfstudio.configs.base_config import MachineConfig
+from nerfstudio.engine.trainer import Trainer, TrainerConfig
+from nerfstudio.scripts.get_plane import derive_nsa, load_checkpoint
+
+# unit cube vertices in the order used by plane_estimation
+VERTICES = np.array(
+    [
+        [0.0, 0.0, 0.0],
+        [0.0, 0.0, 1.0],
+        [0.0, 1.0, 0.0],
+        [0.0, 1.0, 1.0],
+        [1.0, 0.0, 0.0],
+        [1.0, 0.0, 1.0],
+        [1.0, 1.0, 0.0],
+        [1.0, 1.0, 1.0],
+    ]
+)
+
+
+def test_derive_nsa_intersects_vertical_edges():
+    """A horizontal plane through the cube intersects its four vertical edges"""
+    # z - 0.5 = 0
+    intersections = derive_nsa(0.0, 0.0, 1.0, -0.5, VERTICES)
+    assert intersections.shape == (4, 3)
+    assert np.allclose(intersections[:, 2], 0.5)
+    assert np.allclose(np.sort(intersections[:, :2], axis=0), [[0, 0], [0, 0], [1, 1], [1, 1]])
+
+
+def test_derive_nsa_projects_when_not_intersecting():
+    """A plane below the cube gets the vertical edges projected onto it"""
+    # z + 1 = 0
+    intersections = derive_nsa(0.0, 0.0, 1.0, 1.0, VERTICES, dilation_scale=2.0)
+    assert intersections.shape == (4, 3)
+    assert np.allclose(intersections[:, 2], -1.0)
+
+
+def save_trained_checkpoint(tmp_path: Path, **kwargs) -> Trainer:
+    """Saves a checkpoint of a small cpu model the way the trainer does"""
+    config = TrainerConfig(
+        method_name="test", output_dir=tmp_path, machine=MachineConfig(device_type="cpu"), **kwargs
+    )
+    trainer = Trainer(config)
+    model = nn.Linear(4, 2)
+    trainer.pipeline = model  # type: ignore
+    trainer.optimizers = SimpleNamespace(  # type: ignore
+        optimizers={"fields": torch.optim.Adam(model.parameters())}, schedulers={}
+    )
+    trainer.save_checkpoint(step=10)
+    trainer._wait_for_checkpoints()
+    return trainer
+
+
+def load_into_fake_pipeline(config: TrainerConfig) -> Dict[str, Any]:
+    """Runs the plane estimation checkpoint loading and returns what reached the pipeline"""
+    loaded: Dict[str, Any] = {}
+    pipeline = SimpleNamespace(load_pipeline=lambda state, step: loaded.update(state=state, step=step))
+    load_checkpoint(config, pipeline, GradScaler(enabled=False))  # type: ignore
+    return loaded
+
+
+def test_load_checkpoint_npz_layout(tmp_path: Path):
+    """The pipeline tensors of an npz checkpoint reach the pipeline, and the latest step ignores the .npz file"""
+    trainer = save_trained_checkpoint(tmp_path, ckpt_tensor_format="npz")
+    assert (trainer.checkpoint_dir / "step-000000010.npz").exists()
+
+    loaded = load_into_fake_pipeline(TrainerConfig(load_dir=trainer.checkpoint_dir))
+    assert loaded["step"] == 10
+    expected_state = trainer.pipeline.state_dict()
+    assert loaded["state"].keys() == expected_state.keys()
+    for name, tensor in expected_state.items():
+        assert torch.equal(loaded["state"][name], tensor)
+
+
+
+def test_load_checkpoint_batched_layout(tmp_path: Path):
+    """The latest snapshot of a batched checkpoint reaches the pipeline with its own step"""
+    trainer = save_trained_checkpoint(tmp_path, ckpt_batch_size=2)
+    for step in (20, 30):
+        trainer._opt_steps += 1
+        with torch.no_grad():
+            trainer.pipeline.weight.add_(1.0)
+        trainer.save_checkpoint(step=step)
+    trainer._wait_for_checkpoints()
+
+    ckpt_path = trainer.checkpoint_dir / "step-000000030.ckpt"
+    for config in (TrainerConfig(load_dir=trainer.checkpoint_dir), TrainerConfig(load_checkpoint=ckpt_path)):
+        loaded = load_into_fake_pipeline(config)
+        assert loaded["step"] == 30
+        assert torch.equal(loaded["state"]["weight"], trainer.pipeline.weight)
@@ -0,0 +1,40 @@
+"""
+Test the evaluation checkpoint loading
+"""
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict
+
+import torch
+from torch import nn
+
+from nerfstudio.configs.base_config import MachineConfig
+from nerfstudio.engine.trainer import Trainer, TrainerConfig
+from nerfstudio.utils.eval_utils import eval_load_checkpoint
+
+
+def test_eval_load_checkpoint_npz_layout(tmp_path: Path):
+    """Test that the pipeline tensors of an npz checkpoint are loaded from the latest .ckpt file"""
+    config = TrainerConfig(
+        method_name="test",
+        output_dir=tmp_path,
+        machine=MachineConfig(device_type="cpu"),
+        ckpt_tensor_format="npz",
+    )
+    trainer = Trainer(config)
+    model = nn.Linear(4, 2)
+    trainer.pipeline = model  # type: ignore
+    trainer.optimizers = SimpleNamespace(  # type: ignore
+        optimizers={"fields": torch.optim.Adam(model.parameters())}, schedulers={}
+    )
+    trainer.save_checkpoint(step=10)
+    trainer._wait_for_checkpoints()
+
+    loaded: Dict[str, Any] = {}
+    pipeline = SimpleNamespace(load_pipeline=lambda state, step: loaded.update(state=state, step=step))
+    load_config = TrainerConfig(load_dir=trainer.checkpoint_dir)
+    load_path, load_step = eval_load_checkpoint(load_config, pipeline)  # type: ignore
+    assert load_path == trainer.checkpoint_dir / "step-000000010.ckpt"
+    assert load_step == loaded["step"] == 10
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(loaded["state"][name], tensor)